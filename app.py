@@ -1,26 +1,38 @@
 import os
-import io
-import tempfile
+import re
 import datetime
-import json
 import wave
 import logging
 import glob
-import time
+import shutil
+import functools
+import hashlib
 import threading
-
-from flask import Flask, render_template, request, redirect, url_for, flash, Response, send_file, jsonify, session, stream_with_context
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import av
+import numpy as np
+import orjson
+import samplerate
+from cachetools import LRUCache, TTLCache, cached
+from flask import Flask, abort, render_template, request, redirect, url_for, flash, Response, send_from_directory, jsonify, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, bindparam, lambda_stmt, tuple_
+from sqlalchemy.orm import Session, object_session, undefer
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required, UserMixin
 from flask_mail import Mail, Message
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from dotenv import load_dotenv
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from werkzeug.utils import secure_filename
-import subprocess
 from ollama import RequestError, ResponseError
 
 # Import our new LLM service abstraction
-from llm_service import LLMServiceFactory
+from llm_service import LLMServiceFactory, http_session, sse_event, sse_error, is_sse_error
 
 # Import the speech service we created
 from speech_service import speech_service
@@ -29,17 +41,25 @@ from speech_service import speech_service
 load_dotenv()
 
 # Ensure static directories exist
-if not os.path.exists('static'):
-    os.makedirs('static')
-if not os.path.exists('static/css'): # Corrected line
-    os.makedirs('static/css')
-if not os.path.exists('static/js'):
-    os.makedirs('static/js')
-if not os.path.exists('static/uploads'):
-    os.makedirs('static/uploads')
+for static_dir in ('static/css', 'static/js', 'static/uploads'):
+    os.makedirs(static_dir, exist_ok=True)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider that serializes with orjson instead of the stdlib json module"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__, static_folder='static')
+app.json = ORJSONProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', 'you-will-never-guess')
+# No CORS endpoints here, so skip registering automatic OPTIONS handlers (Flask 3.1+)
+app.config['PROVIDE_AUTOMATIC_OPTIONS'] = False
+# Behind Apache/nginx (with X-Sendfile support), let the web server send stored files
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'false').lower() in ['true', '1']
 
 # Retrieve individual MySQL settings from .env
 mysql_user = os.environ.get('MYSQL_USER')
@@ -53,6 +73,16 @@ mysql_port = os.environ.get('MYSQL_PORT', '3306') # Internal Docker port
 connection_str = f"mysql+pymysql://{mysql_user}:{mysql_password}@{mysql_host}:{mysql_port}/{mysql_database}"
 app.config['SQLALCHEMY_DATABASE_URI'] = connection_str
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Keep more compiled SQL statements around so hot queries skip recompilation,
+# and size the connection pool for concurrent chat/voice requests
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'query_cache_size': 1200,
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 20)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_pre_ping': True,  # Detect connections MySQL has dropped instead of failing the request
+    'pool_recycle': 1800,  # Recycle before MySQL's wait_timeout closes idle connections
+    'pool_use_lifo': True,  # Reuse the most recent connection so idle extras can time out
+}
 
 # Initialize SQLAlchemy AFTER app is created and configured
 db = SQLAlchemy(app)
@@ -66,10 +96,25 @@ app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER')
 mail = Mail(app)
 
+# Outgoing mail is sent in the background so requests don't wait on SMTP
+mail_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='mail')
+
+def send_mail_task(msg):
+    """Send a Flask-Mail message from a background thread, logging failures"""
+    with app.app_context():
+        try:
+            mail.send(msg)
+        except Exception as e:
+            logger.exception(f"Failed to send mail to {msg.recipients}: {e}")
+
 # Configure Flask-Login
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+# Signs the email confirmation and password reset tokens
+_serializer = URLSafeTimedSerializer(app.secret_key)
+RESET_TOKEN_MAX_AGE = 3600  # seconds
+
 # Add logging setup near the top of your file, after imports
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -87,32 +132,39 @@ else:  # llamacpp
 
 logger.info(f"Using default model: {DEFAULT_MODEL_NAME}")
 
+# Maps ChatMessage.sender to the chat role the LLM API expects; any other
+# sender is treated as the assistant
+ROLE_MAP = {'user': 'user', 'ai': 'assistant'}
+
 # Add a template filter for converting newlines to <br> tags
+_MULTIBR_RE = re.compile(r'(?:<br>){3,}')
+
 @app.template_filter('nl2br')
 def nl2br(value):
     # First trim the string to remove leading/trailing whitespace
     if not value:
         return value
-    value = value.strip()
-    # Replace newlines with <br> tags
-    value = value.replace('\n', '<br>')
-    # Remove any double <br> tags that might cause excessive spacing
-    while '<br><br><br>' in value:
-        value = value.replace('<br><br><br>', '<br><br>')
-    return value
-
-# Print all registered routes for debugging (always runs)
-print("\n=== Registered Flask Routes ===")
-try:
-    for rule in app.url_map.iter_rules():
-        print(f"{rule.endpoint}: {rule}")
-except Exception as e:
-    print(f"Error printing routes: {e}")
-print("==============================\n")
+    # Replace newlines with <br> tags, then collapse runs of three or more
+    # <br> tags into two to avoid excessive spacing
+    return _MULTIBR_RE.sub('<br><br>', value.strip().replace('\n', '<br>'))
 
 # ===========================
 # Database Models
 # ===========================
+# argon2id with OWASP's minimum recommended parameters (19 MiB, 2 passes)
+_password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+# Verified against when a login email is unknown, so the response takes as
+# long as a real password check and doesn't reveal whether the account exists
+_DUMMY_PASSWORD_HASH = _password_hasher.hash(uuid.uuid4().hex)
+
+def verify_dummy_password(password):
+    """Spend the same argon2 work as User.check_password and return False"""
+    try:
+        _password_hasher.verify(_DUMMY_PASSWORD_HASH, password)
+    except (VerificationError, InvalidHashError):
+        pass
+    return False
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
@@ -124,10 +176,27 @@ class User(UserMixin, db.Model):
     conversations = db.relationship('Conversation', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = _password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify a password; legacy werkzeug hashes are upgraded to argon2id on success.
+
+        The caller must commit the session for an upgraded hash to be saved.
+        """
+        if not self.password_hash:
+            return False
+        if not self.password_hash.startswith('$argon2'):
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.set_password(password)
+            return True
+        try:
+            _password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if _password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
 class Conversation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -139,6 +208,9 @@ class Conversation(db.Model):
     messages = db.relationship('ChatMessage', backref='conversation', cascade="all, delete-orphan", lazy=True)
     documents = db.relationship('Document', backref='conversation', cascade="all, delete-orphan", lazy=True)
 
+    # Serves the per-user conversation list ordered by newest first
+    __table_args__ = (db.Index('ix_conv_user_created', 'user_id', 'created_at'),)
+
 class ChatMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
@@ -146,25 +218,161 @@ class ChatMessage(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
+    # Serves loading a conversation's messages in order
+    __table_args__ = (db.Index('ix_msg_conv_created', 'conversation_id', 'created_at'),)
+
 class Document(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False, index=True)
     filename = db.Column(db.String(256))
-    data = db.Column(db.LargeBinary)  # store file as BLOB
+    storage_path = db.Column(db.String(512))  # file name inside DOCUMENT_STORAGE_DIR
+    # Filled in the background after upload; sized so MySQL uses LONGTEXT.
+    # Deferred so listing a conversation's documents doesn't pull the text.
+    extracted_text = db.deferred(db.Column(db.Text(length=2**32 - 1), nullable=True))
     mime_type = db.Column(db.String(128))
     uploaded_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
+# ===========================
+# Document file storage
+# ===========================
+# Uploaded documents and voice recordings live on disk; the DB keeps only the path.
+# Deliberately outside static/ so files are only reachable through the
+# ownership-checked routes.
+DOCUMENT_STORAGE_DIR = os.environ.get('DOCUMENT_STORAGE_DIR', os.path.join(app.root_path, 'document_store'))
+os.makedirs(DOCUMENT_STORAGE_DIR, exist_ok=True)
+DOCUMENT_COPY_BUFFER_SIZE = 1024 * 1024
+
+def save_document_file(source):
+    """Write an uploaded file (FileStorage), raw bytes or a local file to the document store.
+
+    A path (str) is moved into the store, which is a rename when it is on the
+    same filesystem, so the file is never read into memory.
+
+    Returns:
+        str: Storage name to keep in Document.storage_path
+    """
+    storage_name = f"{uuid.uuid4().hex}.bin"
+    path = os.path.join(DOCUMENT_STORAGE_DIR, storage_name)
+    if isinstance(source, (bytes, bytearray)):
+        with open(path, 'wb') as f:
+            f.write(source)
+    elif isinstance(source, str):
+        shutil.move(source, path)
+    else:
+        # Stream the upload to disk in large chunks rather than reading it into memory
+        source.save(path, buffer_size=DOCUMENT_COPY_BUFFER_SIZE)
+    return storage_name
+
+def document_file_path(document):
+    """Absolute path of a document's file in the document store"""
+    return os.path.join(DOCUMENT_STORAGE_DIR, document.storage_path)
+
+def read_document_data(document, max_bytes=None):
+    """Read a document's contents (or only the first max_bytes) from the document store"""
+    with open(document_file_path(document), 'rb') as f:
+        return f.read(-1 if max_bytes is None else max_bytes)
+
+def send_document_file(document, mimetype=None):
+    """Serve a document's file; Werkzeug streams it (sendfile where available) with range support"""
+    return send_from_directory(
+        DOCUMENT_STORAGE_DIR,
+        document.storage_path,
+        mimetype=mimetype or document.mime_type,
+        as_attachment=False,
+        download_name=document.filename,
+        conditional=True
+    )
+
+# Files of deleted Document rows are only removed once the delete is
+# committed; a rolled-back transaction keeps both the row and its file.
+# Likewise a file written for a new row is removed if its transaction rolls back.
+_REMOVED_FILES_KEY = 'removed_document_files'
+_NEW_FILES_KEY = 'new_document_files'
+
+def track_new_document_file(storage_name):
+    """Register a just-written store file so it is removed if the current transaction rolls back"""
+    db.session.info.setdefault(_NEW_FILES_KEY, []).append(os.path.join(DOCUMENT_STORAGE_DIR, storage_name))
+    return storage_name
+
+@db.event.listens_for(Document, 'after_delete')
+def queue_document_file_removal(mapper, connection, document):
+    """Remember the stored file of a deleted Document row (including conversation cascades)"""
+    session = object_session(document)
+    if document.storage_path and session is not None:
+        session.info.setdefault(_REMOVED_FILES_KEY, []).append(document_file_path(document))
+
+@db.event.listens_for(Session, 'after_commit')
+def remove_deleted_document_files(session):
+    """Delete the files of Document rows removed in the committed transaction; new files are kept"""
+    session.info.pop(_NEW_FILES_KEY, None)
+    _remove_document_files(session.info.pop(_REMOVED_FILES_KEY, ()))
+
+@db.event.listens_for(Session, 'after_soft_rollback')
+def discard_document_file_changes(session, previous_transaction):
+    """Keep deleted rows' files and drop files written for rows that were never committed"""
+    if previous_transaction.nested:
+        return
+    session.info.pop(_REMOVED_FILES_KEY, None)
+    _remove_document_files(session.info.pop(_NEW_FILES_KEY, ()))
+
+def _remove_document_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to remove document file {path}: {e}")
+
+# Cached user lookups; the compiled SQL is reused across requests
+_USER_BY_EMAIL = lambda_stmt(lambda: select(User).where(User.email == bindparam('email')))
+_USER_BY_USERNAME = lambda_stmt(lambda: select(User).where(User.username == bindparam('username')))
+
+def get_user_by_email(email):
+    return db.session.execute(_USER_BY_EMAIL, {'email': email}).scalar_one_or_none()
+
+def get_user_by_username(username):
+    return db.session.execute(_USER_BY_USERNAME, {'username': username}).scalar_one_or_none()
+
+# Ownership-scoped lookups: the user_id filter is part of the query, so a
+# missing row and someone else's row both come back as None
+def get_owned_conversation(conversation_id):
+    return db.session.execute(
+        select(Conversation)
+        .where(Conversation.id == conversation_id, Conversation.user_id == current_user.id)
+    ).scalar_one_or_none()
+
+def get_owned_message(message_id):
+    return db.session.execute(
+        select(ChatMessage)
+        .join(Conversation, ChatMessage.conversation_id == Conversation.id)
+        .where(ChatMessage.id == message_id, Conversation.user_id == current_user.id)
+    ).scalar_one_or_none()
+
+def get_owned_document(document_id):
+    return db.session.execute(
+        select(Document)
+        .join(Conversation, Document.conversation_id == Conversation.id)
+        .where(Document.id == document_id, Conversation.user_id == current_user.id)
+    ).scalar_one_or_none()
+
 # ===========================
 # Flask-Login loader
 # ===========================
 @login_manager.user_loader
 def load_user(user_id):
+    # Flask-Login caches the result on flask.g, so this runs at most once per
+    # request and only when current_user is touched. Keep the DB lookup so
+    # deleted users lose access immediately.
     return db.session.get(User, int(user_id))
 
-@app.route('/')
+@app.get('/')
 def index():
     return render_template('index.html')
 
+# Number of conversations listed per sidebar page in /chat
+SIDEBAR_CONVERSATION_LIMIT = int(os.environ.get('SIDEBAR_CONVERSATION_LIMIT', 50))
+
 # ===========================
 # Ollama model listing at startup
 # ===========================
@@ -172,7 +380,7 @@ def load_llm_models():
     """Load models from the configured LLM service"""
     try:
         logger.info(f"Attempting to list models from {llm_service_type} service")
-        models = llm_service.list_models()
+        models = list(cached_list_models(llm_service_type))
         
         if not models:
             logger.warning(f"No models found. Will use default model: {DEFAULT_MODEL_NAME}")
@@ -184,16 +392,79 @@ def load_llm_models():
         logger.exception(f"Error loading {llm_service_type} models: {e}")
         return [DEFAULT_MODEL_NAME]
 
+# Model listings are cached briefly so UI polling and diagnostics don't hit
+# the LLM backend on every request; the /api/tags probe uses a shorter TTL
+MODELS_CACHE_TTL = int(os.environ.get('MODELS_CACHE_TTL', 30))
+_models_cache = TTLCache(maxsize=8, ttl=MODELS_CACHE_TTL)
+_models_cache_lock = threading.Lock()
+_ollama_probe_cache = TTLCache(maxsize=4, ttl=5)
+
+def cached_list_models(service_type, service=None):
+    """Return a service's models as a tuple, cached per service type.
+
+    ``service`` defaults to the active service. Empty results are not
+    cached, so a backend that was down is retried on the next call.
+    """
+    with _models_cache_lock:
+        models = _models_cache.get(service_type)
+    if models is None:
+        models = tuple((service or llm_service).list_models())
+        if models:
+            with _models_cache_lock:
+                _models_cache[service_type] = models
+    return models
+
+@cached(_ollama_probe_cache, lock=threading.Lock())
+def probe_ollama_tags(health_url):
+    """GET the Ollama /api/tags endpoint and return (status_code, json)."""
+    response = http_session.get(health_url, timeout=5)
+    return response.status_code, response.json()
+
+@functools.lru_cache(maxsize=4)
+def get_service_instance_for_type(service_type):
+    """Create the LLM service for a type once per process"""
+    return LLMServiceFactory.create_service_by_type(service_type)
+
+def get_llm_service_for_type(service_type):
+    """Return the service for a type and its models.
+
+    The service instance is reused; the model list goes through
+    cached_list_models, so an empty result from an unreachable backend is
+    retried rather than kept.
+
+    Returns:
+        tuple: (service, tuple of model names)
+    """
+    service = get_service_instance_for_type(service_type)
+    return service, cached_list_models(service_type, service)
+
 llm_models = load_llm_models()
 # Ensure there's at least a default model name in the config, even if loading failed
 app.config['LLM_MODELS'] = llm_models if llm_models else [DEFAULT_MODEL_NAME]
 logger.info(f"Using models for dropdown: {app.config['LLM_MODELS']}")
 
+# Whisper expects 16kHz input; the libsamplerate converter is configurable
+# (e.g. AUDIO_RESAMPLE_CONVERTER=sinc_best for higher quality)
+WHISPER_SAMPLE_RATE = 16000
+AUDIO_RESAMPLE_CONVERTER = os.environ.get('AUDIO_RESAMPLE_CONVERTER', 'sinc_fastest')
+
+# Number of most recent messages sent to the LLM as conversation context
+MAX_CONTEXT_MESSAGES = int(os.environ.get('MAX_CONTEXT_MESSAGES', 40))
+
+# Map the UI language names to Whisper language codes
+WHISPER_LANGUAGE_CODES = {
+    'english': 'en',
+    'persian': 'fa',
+}
+
 # ===========================
 # Voice Processing functions using faster-whisper & Bark (via speech_service)
 # ===========================
 def check_whisper_model_exists(model_name="base"):
     """Check if the specified faster-whisper model can be loaded via speech_service"""
+    # Once loaded the model stays loaded; skip the lock and logging on every voice request
+    if speech_service.whisper_model is not None:
+        return True
     try:
         speech_service.load_whisper_model(model_name)
         logger.info(f"Whisper model '{model_name}' is available via speech_service")
@@ -202,107 +473,76 @@ def check_whisper_model_exists(model_name="base"):
         logger.exception(f"Error checking Whisper model via speech_service: {e}")
         return False
 
-def check_ffmpeg_installed():
-    """Check if FFmpeg is installed and available in the system path"""
-    try:
-        # Keep using subprocess for ffmpeg check
-        subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        logger.info("FFmpeg is installed and available")
-        return True
-    except FileNotFoundError:
-        logger.warning("FFmpeg is not installed or not in system PATH")
-        return False
-    except subprocess.CalledProcessError:
-        # Handles cases where ffmpeg exists but returns non-zero exit code on -version
-        logger.info("FFmpeg is installed (returned non-zero on -version, but likely ok)")
-        return True
-    except Exception as e:
-        logger.error(f"Error checking FFmpeg: {e}")
-        return False
+# Warm the Whisper model when the server starts (see __main__)
+WHISPER_WARMUP = os.environ.get('WHISPER_WARMUP', 'true').lower() in ['true', '1']
 
-def recognize_audio(file_path, language=None):
-    """Recognize audio using speech_service"""
+def warmup_whisper_model():
+    """Warm up the Whisper model in the background so the first voice request doesn't pay the load cost"""
     try:
-        # Verify the file exists and is readable
-        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-            logger.error(f"Audio file does not exist or is empty: {file_path}")
-            return {"text": "Error: Audio file is missing or empty", "language": "en"}
-
-        logger.info(f"Processing audio file: {file_path}, Size: {os.path.getsize(file_path)} bytes")
-        # Clarify that 'language' here is the code passed to the service
-        logger.info(f"Using language code hint for transcription: {language}")
+        speech_service.warmup()
+    except Exception as e:
+        logger.warning(f"Whisper warmup failed: {e}")
 
-        # Read the audio file into memory
-        with open(file_path, 'rb') as f:
-            audio_data = f.read()
+def recognize_audio_stream(stream, language=None):
+    """Recognize audio read from a file-like object (e.g. an upload stream).
 
-        # Transcribe using speech_service
-        result = speech_service.transcribe_audio(audio_data, language=language)
+    Raises:
+        ValueError: If the stream is empty or cannot be decoded
+    """
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    if size == 0:
+        raise ValueError("Audio stream is empty")
+
+    logger.info(f"Processing audio stream, Size: {size} bytes")
+    audio_data = convert_audio_format(stream)
+    if audio_data is None:
+        raise ValueError("Could not decode audio stream")
+    return speech_service.transcribe_audio(audio_data, language=language)
 
-        # Return the result dictionary
-        return result
+def convert_audio_format(input_path):
+    """Decode audio into the format required by Whisper: float32 samples, 16kHz, mono.
 
-    except Exception as e:
-        logger.exception(f"Voice recognition failed: {e}")
-        return {"text": f"Error processing voice: {str(e)}", "language": "en"}
+    Decoding happens in-process through PyAV (libav bindings), so no ffmpeg
+    subprocess or intermediate WAV file is needed. ``input_path`` may be a
+    path or a seekable file-like object. PyAV only downmixes to mono at the
+    source rate; the 16kHz resample is done by libsamplerate.
 
-def convert_audio_format(input_path):
-    """Convert audio to the format required by Whisper: WAV, 16kHz, 16-bit, mono"""
+    Returns:
+        np.ndarray: float32 samples in [-1, 1], or None if decoding failed
+    """
     try:
-        # First check if ffmpeg is available
-        if not check_ffmpeg_installed():
-            logger.error("FFmpeg is not installed. Cannot convert audio format.")
+        logger.info(f"Decoding audio file {input_path} to format required by Whisper")
+
+        resampler = av.AudioResampler(format='flt', layout='mono')
+        chunks = []
+        source_rate = None
+        with av.open(input_path) as container:
+            for frame in container.decode(audio=0):
+                source_rate = source_rate or frame.sample_rate
+                for resampled in resampler.resample(frame):
+                    chunks.append(resampled.to_ndarray().reshape(-1))
+            # Flush any samples still buffered in the resampler
+            for resampled in resampler.resample(None):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+
+        if not chunks:
+            logger.error("Decoded audio is empty")
             return None
-        
-        output_path = input_path + ".converted.wav"
-        logger.info(f"Converting audio file {input_path} to format required by Whisper")
-        
-        # Use ffmpeg with more explicit parameters to ensure proper WAV format
-        subprocess.run([
-            "ffmpeg", "-y", "-i", input_path,  # -y to overwrite output file
-            "-acodec", "pcm_s16le",  # 16-bit PCM
-            "-ar", "16000",          # 16kHz sample rate
-            "-ac", "1",              # mono channel
-            "-f", "wav",             # force WAV format
-            output_path
-        ], check=True, stderr=subprocess.PIPE)
-        
-        # Verify the converted file exists and has content
-        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-            logger.error("Converted file is empty or does not exist")
-            return None
-        
-        logger.info(f"Successfully converted audio to {output_path}")
-        return output_path
-    except subprocess.CalledProcessError as e:
-        logger.error(f"FFmpeg conversion failed: {e.stderr.decode() if e.stderr else str(e)}")
+
+        audio = np.concatenate(chunks).astype(np.float32, copy=False)
+        if source_rate != WHISPER_SAMPLE_RATE:
+            audio = samplerate.resample(audio, WHISPER_SAMPLE_RATE / source_rate, AUDIO_RESAMPLE_CONVERTER).astype(np.float32, copy=False)
+        logger.info(f"Successfully decoded {audio.shape[0]} samples from {input_path}")
+        return audio
+    except av.error.FFmpegError as e:
+        logger.error(f"Audio decoding failed: {e}")
         return None
     except Exception as e:
         logger.exception(f"Audio conversion failed: {str(e)}")
         return None
 
-def detect_language(audio_file_path):
-    """Detects language from audio using faster-whisper via speech_service.
-    Returns the detected language code (e.g., 'en', 'fa').
-    """
-    logger.info("Detecting language from audio sample...")
-    try:
-        # Read audio file
-        with open(audio_file_path, 'rb') as f:
-            audio_data = f.read()
-
-        # Use speech service to transcribe without specifying a language
-        result = speech_service.transcribe_audio(audio_data)
-
-        # Return the detected language code
-        detected_language = result.get("language", "en")
-        logger.info(f"Detected language code: {detected_language}")
-        return detected_language
-
-    except Exception as e:
-        logger.exception(f"Language detection failed: {e}")
-        return "en"  # Default to English on error
-
 # ===========================
 # Routes for Authentication
 # ===========================
@@ -314,8 +554,8 @@ def register():
         password = request.form['password']
         logger.info(f"Registration attempt - Username: '{username}', Email: '{email}'") # Add logging
 
-        existing_user_by_username = User.query.filter_by(username=username).first()
-        existing_user_by_email = User.query.filter_by(email=email).first()
+        existing_user_by_username = get_user_by_username(username)
+        existing_user_by_email = get_user_by_email(email)
 
         error = False
         if existing_user_by_username:
@@ -350,11 +590,11 @@ def register():
 
     return render_template('register.html')
     
-@app.route('/confirm/<token>')
+@app.get('/confirm/<token>')
 def confirm_email(token):
     try:
-        user_id = int(token.split('-')[0])
-    except Exception:
+        user_id = _serializer.loads(token, salt='email-confirm')
+    except BadSignature:
         flash("Invalid confirmation token.")
         return redirect(url_for('login'))
     user = db.session.get(User, user_id)
@@ -369,8 +609,13 @@ def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
-        user = User.query.filter_by(email=email).first()
-        if user and user.check_password(password):
+        user = get_user_by_email(email)
+        if user is None:
+            verify_dummy_password(password)
+        elif user.check_password(password):
+            # Persist the hash if check_password upgraded it
+            if db.session.is_modified(user):
+                db.session.commit()
             if not user.confirmed:
                 flash("Please confirm your email before logging in.")
                 return redirect(url_for('login'))
@@ -379,7 +624,7 @@ def login():
         flash("Invalid email or password.")
     return render_template('login.html')
 
-@app.route('/logout')
+@app.get('/logout')
 @login_required
 def logout():
     logout_user()
@@ -389,13 +634,13 @@ def logout():
 def reset_request():
     if request.method == 'POST':
         email = request.form['email']
-        user = User.query.filter_by(email=email).first()
+        user = get_user_by_email(email)
         if user:
-            token = f"{user.id}-reset-token"  # Replace with secure token generation.
+            token = _serializer.dumps(user.id, salt='pwd-reset')
             reset_url = url_for('reset_password', token=token, _external=True)
             msg = Message("Password Reset", recipients=[email])
             msg.body = f"Reset your password by clicking on the link: {reset_url}"
-            mail.send(msg)
+            mail_executor.submit(send_mail_task, msg)
             flash("Password reset email sent.")
         else:
             flash("Email not found.")
@@ -404,11 +649,15 @@ def reset_request():
 @app.route('/reset_password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
     try:
-        user_id = int(token.split('-')[0])
-    except Exception:
-        flash("Invalid reset token.")
+        user_id = _serializer.loads(token, max_age=RESET_TOKEN_MAX_AGE, salt='pwd-reset')
+    except BadSignature:
+        # Also covers SignatureExpired
+        flash("Invalid or expired reset token.")
         return redirect(url_for('reset_request'))
     user = db.session.get(User, user_id)
+    if not user:
+        flash("Invalid reset token.")
+        return redirect(url_for('reset_request'))
     if request.method == 'POST':
         new_password = request.form['password']
         user.set_password(new_password)
@@ -433,16 +682,15 @@ def chat():
         try:
             logger.info(f"Switching to user's preferred LLM service: {user_service}")
             
-            # Try to create the service and test it
-            temp_service = LLMServiceFactory.create_service_by_type(user_service)
-            available_models = temp_service.list_models()
+            # Reuse the cached service for this type (created and tested once per process)
+            temp_service, available_models = get_llm_service_for_type(user_service)
             
             # If we get here, the service is working
             llm_service = temp_service
             llm_service_type = user_service
             
             # Update the application's cached models list
-            app.config['LLM_MODELS'] = available_models if available_models else [DEFAULT_MODEL_NAME]
+            app.config['LLM_MODELS'] = list(available_models) if available_models else [DEFAULT_MODEL_NAME]
             logger.info(f"Switched to user's preferred service {user_service} with models: {app.config['LLM_MODELS']}")
         except Exception as e:
             logger.exception(f"Failed to switch to user's preferred service {user_service}: {e}")
@@ -453,15 +701,50 @@ def chat():
     conversation_id = request.args.get('conversation_id', None)
     available_models = app.config['LLM_MODELS']
 
+    # The sidebar shows one page of conversations, newest first;
+    # ?before=<iso timestamp>&before_id=<id> pages back through older ones.
+    # The id breaks ties between conversations created in the same second
+    # (DATETIME has one-second resolution). One extra row tells us whether an
+    # older page exists.
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', type=int)
+    sidebar_query = select(Conversation).where(Conversation.user_id == current_user.id)
+    if before:
+        try:
+            before_at = datetime.datetime.fromisoformat(before)
+        except ValueError:
+            abort(400)
+        if before_id is None:
+            sidebar_query = sidebar_query.where(Conversation.created_at < before_at)
+        else:
+            sidebar_query = sidebar_query.where(
+                tuple_(Conversation.created_at, Conversation.id) < tuple_(before_at, before_id))
+    all_conversations = db.session.execute(
+        sidebar_query.order_by(Conversation.created_at.desc(), Conversation.id.desc())
+        .limit(SIDEBAR_CONVERSATION_LIMIT + 1)
+    ).scalars().all()
+    older_before = older_before_id = None
+    if len(all_conversations) > SIDEBAR_CONVERSATION_LIMIT:
+        all_conversations = all_conversations[:SIDEBAR_CONVERSATION_LIMIT]
+        older_before = all_conversations[-1].created_at.isoformat()
+        older_before_id = all_conversations[-1].id
+
     if conversation_id:
-        conversation = Conversation.query.filter_by(id=conversation_id, user_id=current_user.id).first_or_404()
+        # Usually on the current sidebar page; otherwise fetch it directly
+        conversation = (next((c for c in all_conversations if str(c.id) == str(conversation_id)), None)
+                        or get_owned_conversation(conversation_id))
+        if conversation is None:
+            abort(404)
         # Ensure the conversation's selected model is still valid, fallback if not
         if conversation.selected_model not in available_models:
             logger.warning(f"Conversation {conversation.id} had model '{conversation.selected_model}' which is not available. Falling back to '{available_models[0]}'.")
             conversation.selected_model = available_models[0]
             db.session.commit()
     else:
-        conversation = Conversation.query.filter_by(user_id=current_user.id).order_by(Conversation.created_at.desc()).first()
+        conversation = all_conversations[0] if all_conversations else None
+        if not conversation and before:
+            # Paged past the oldest conversation
+            return redirect(url_for('chat'))
         if not conversation:
             # Use the first available model or the default
             default_conv_model = available_models[0]
@@ -473,25 +756,26 @@ def chat():
             )
             db.session.add(conversation)
             db.session.commit()
+            all_conversations = [conversation]
         # Fallback check for existing conversation without a valid model
         elif conversation.selected_model not in available_models:
              logger.warning(f"Latest conversation {conversation.id} had model '{conversation.selected_model}' which is not available. Falling back to '{available_models[0]}'.")
              conversation.selected_model = available_models[0]
              db.session.commit()
 
-
-    all_conversations = Conversation.query.filter_by(user_id=current_user.id).order_by(Conversation.created_at.desc()).all()
     messages = ChatMessage.query.filter_by(conversation_id=conversation.id).order_by(ChatMessage.created_at).all()
     
     # Pass the LLM service type to the template
     return render_template('chat.html', 
                           conversation=conversation, 
                           all_conversations=all_conversations,
+                          older_before=older_before,
+                          older_before_id=older_before_id,
                           messages=messages, 
                           models=available_models,
                           llm_service_type=llm_service_type) # Add this line
 
-@app.route('/conversation/new', methods=['POST'])
+@app.post('/conversation/new')
 @login_required
 def new_conversation():
     available_models = app.config['LLM_MODELS']
@@ -513,12 +797,11 @@ def new_conversation():
     db.session.commit()
     return redirect(url_for('chat', conversation_id=conversation.id))
 
-@app.route('/conversation/<int:conversation_id>/rename', methods=['POST'])
+@app.post('/conversation/<int:conversation_id>/rename')
 @login_required
 def rename_conversation(conversation_id):
-    conversation = db.session.get(Conversation, conversation_id)
-    # Check ownership
-    if conversation.user_id != current_user.id:
+    conversation = get_owned_conversation(conversation_id)
+    if conversation is None:
         flash("Unauthorized access")
         return redirect(url_for('chat'))
     new_title = request.form.get('title', 'Untitled Conversation')
@@ -528,12 +811,11 @@ def rename_conversation(conversation_id):
     flash("Conversation renamed successfully")
     return redirect(url_for('chat', conversation_id=conversation_id))
 
-@app.route('/conversation/<int:conversation_id>/delete', methods=['POST'])
+@app.post('/conversation/<int:conversation_id>/delete')
 @login_required
 def delete_conversation(conversation_id):
-    conversation = db.session.get(Conversation, conversation_id)
-    # Check ownership
-    if conversation.user_id != current_user.id:
+    conversation = get_owned_conversation(conversation_id)
+    if conversation is None:
         flash("Unauthorized access")
         return redirect(url_for('chat'))
     else:
@@ -542,24 +824,25 @@ def delete_conversation(conversation_id):
         flash("Conversation deleted")
     return redirect(url_for('chat'))
 
-@app.route('/switch_model', methods=['POST'])
+@app.post('/switch_model')
 @login_required
 def switch_model():
     conversation_id = request.form['conversation_id']
     new_model = request.form['model']
-    conversation = db.session.get(Conversation, conversation_id)
-    if conversation and conversation.user_id == current_user.id:
+    conversation = get_owned_conversation(conversation_id)
+    if conversation:
         conversation.selected_model = new_model
         db.session.commit()
         flash("Model switched successfully.")
     return redirect(url_for('chat'))
 
-@app.route('/edit_message/<int:message_id>', methods=['POST'])
+@app.post('/edit_message/<int:message_id>')
 @login_required
 def edit_message(message_id):
     new_content = request.form['content']
-    message = db.session.get(ChatMessage, message_id)
-    if message and message.conversation.user_id == current_user.id:
+    # Check ownership in the same query instead of lazy-loading the conversation
+    message = get_owned_message(message_id)
+    if message:
         message.content = new_content
         db.session.commit()
         flash("Message updated.")
@@ -568,46 +851,169 @@ def edit_message(message_id):
 # ===========================
 # File and Voice Upload Routes
 # ===========================
-def extract_text_from_document(document):
-    """Extract text content from a document based on its MIME type"""
+# Optional document parsers, resolved once at import
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+try:
+    from pdfminer.high_level import extract_text as pdf_extract_text
+except ImportError:
+    pdf_extract_text = None
+try:
+    import docx
+    from docx.oxml.ns import qn
+    # Run-level elements that make up a paragraph's text, as python-docx's Run.text reads them
+    _DOCX_TEXT_TAGS = (qn('w:t'), qn('w:tab'), qn('w:br'), qn('w:cr'))
+    _DOCX_TEXT_SEPARATORS = {qn('w:tab'): '\t', qn('w:br'): '\n', qn('w:cr'): '\n'}
+except ImportError:
+    docx = None
+
+class DocumentTextUnavailable(Exception):
+    """Raised when a document's text can't be extracted (unsupported type or missing parser).
+
+    The message is shown to the user in place of the document text.
+    """
+
+def _join_limited(parts, max_chars=None):
+    """Join text parts with newlines, stopping once max_chars have been collected"""
+    if max_chars is None:
+        return "\n".join(parts)
+    collected = []
+    total = 0
+    for part in parts:
+        collected.append(part)
+        total += len(part) + 1
+        if total >= max_chars:
+            break
+    return "\n".join(collected)[:max_chars]
+
+def _extract_plain_text(document, max_chars=None):
+    # UTF-8 needs at most 4 bytes per character, so only read that much
+    max_bytes = None if max_chars is None else max_chars * 4
+    # Replace undecodable bytes instead of failing the whole extraction
+    text = read_document_data(document, max_bytes).decode('utf-8', errors='replace')
+    return text if max_chars is None else text[:max_chars]
+
+def _extract_pdf_text(document, max_chars=None):
+    # Prefer PyMuPDF's C engine; pdfminer.six is the pure-Python fallback,
+    # also used for files PyMuPDF fails to parse
+    if fitz is not None:
+        try:
+            with fitz.open(document_file_path(document), filetype='pdf') as pdf:
+                return _join_limited((page.get_text("text") for page in pdf), max_chars)
+        except Exception as e:
+            if pdf_extract_text is None:
+                raise
+            logger.warning(f"PyMuPDF failed on document {document.id}, falling back to pdfminer: {e}")
+    if pdf_extract_text is None:
+        logger.warning("Neither PyMuPDF nor pdfminer.six is installed. Cannot extract PDF text.")
+        raise DocumentTextUnavailable("PDF text extraction requires PyMuPDF. Please install it with: pip install PyMuPDF")
+    text = pdf_extract_text(document_file_path(document))
+    return text if max_chars is None else text[:max_chars]
+
+def _extract_docx_text(document, max_chars=None):
+    if docx is None:
+        logger.warning("python-docx not installed. Cannot extract DOCX text.")
+        raise DocumentTextUnavailable("DOCX text extraction requires python-docx. Please install it with: pip install python-docx")
+    doc = docx.Document(document_file_path(document))
+    # Walk the lxml tree directly instead of building Paragraph/Run wrappers.
+    # Like doc.paragraphs / Paragraph.text, only top-level body paragraphs and
+    # their direct runs are read (no tab-stop definitions, hyperlinks or text boxes)
+    paragraphs = (
+        "".join((elem.text or "") if elem.tag == _DOCX_TEXT_TAGS[0] else _DOCX_TEXT_SEPARATORS[elem.tag]
+                for r in p.iterchildren(qn('w:r'))
+                for elem in r.iterchildren(*_DOCX_TEXT_TAGS))
+        for p in doc.element.body.iterchildren(qn('w:p'))
+    )
+    return _join_limited(paragraphs, max_chars)
+
+# Text extractors keyed by MIME type
+DOCUMENT_TEXT_EXTRACTORS = {
+    'text/plain': _extract_plain_text,
+    'application/pdf': _extract_pdf_text,
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': _extract_docx_text,
+}
+
+def parse_document_text(document, max_chars=None):
+    """Run the extractor for the document's MIME type.
+
+    Raises DocumentTextUnavailable for unsupported types or missing parsers;
+    parser errors propagate as is.
+    """
+    extractor = DOCUMENT_TEXT_EXTRACTORS.get(document.mime_type)
+    if extractor is None:
+        raise DocumentTextUnavailable(f"Content extraction not supported for {document.mime_type}. Using filename only.")
+    return extractor(document, max_chars)
+
+def extract_text_from_document(document, max_chars=None):
+    """Extract text content from a document based on its MIME type.
+
+    If max_chars is given, extraction stops once that many characters are collected.
+    Text already stored on the row by extract_document_task is returned as is;
+    otherwise (still queued, or an earlier attempt failed) it is parsed now.
+    Returns None if no text can be extracted.
+    """
+    if document.extracted_text is not None:
+        return document.extracted_text if max_chars is None else document.extracted_text[:max_chars]
     try:
-        mime_type = document.mime_type
-        
-        # For plain text files
-        if (mime_type == 'text/plain'):
-            return document.data.decode('utf-8')
-        # For PDF files
-        elif mime_type == 'application/pdf':
-            try:
-                import io
-                from pdfminer.high_level import extract_text
-                pdf_file = io.BytesIO(document.data)
-                text = extract_text(pdf_file)
-                return text
-            except ImportError:
-                logger.warning("pdfminer.six not installed. Cannot extract PDF text.")
-                return "PDF text extraction requires pdfminer.six. Please install it with: pip install pdfminer.six"
-                
-        # For docx files
-        elif mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-            try:
-                import io
-                import docx
-                docx_file = io.BytesIO(document.data)
-                doc = docx.Document(docx_file)
-                return "\n".join([para.text for para in doc.paragraphs])
-            except ImportError:
-                logger.warning("python-docx not installed. Cannot extract DOCX text.")
-                return "DOCX text extraction requires python-docx. Please install it with: pip install python-docx"
-        
-        # For other formats, return a message
-        else:
-            return f"Content extraction not supported for {mime_type}. Using filename only."
+        return parse_document_text(document, max_chars)
+    except DocumentTextUnavailable as e:
+        logger.warning(f"No text for document {document.id}: {e}")
+        return None
     except Exception as e:
         logger.exception(f"Error extracting text from document: {str(e)}")
-        return f"Error extracting text: {str(e)}"
+        return None
+
+# Upper bound on stored document text; also bounds work on huge uploads
+DOCUMENT_TEXT_MAX_CHARS = int(os.environ.get('DOCUMENT_TEXT_MAX_CHARS', 1_000_000))
+
+# Background pool for document parsing so uploads don't wait on it
+document_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='doc-extract')
+
+def extract_document_task(document_id):
+    """Extract a document's text in the background and store it on the row"""
+    with app.app_context():
+        try:
+            doc = db.session.get(Document, document_id)
+            if not doc:
+                logger.warning(f"Document {document_id} disappeared before text extraction")
+                return
+            # Failures leave extracted_text NULL so a later read tries again
+            doc.extracted_text = parse_document_text(doc, max_chars=DOCUMENT_TEXT_MAX_CHARS)
+            db.session.commit()
+            logger.info(f"Extracted {len(doc.extracted_text or '')} characters from document {document_id}")
+        except DocumentTextUnavailable as e:
+            logger.warning(f"No text stored for document {document_id}: {e}")
+        except Exception as e:
+            logger.exception(f"Background text extraction failed for document {document_id}: {e}")
+            db.session.rollback()
+
+# Characters of document text sent to the LLM in document mode
+DOCUMENT_CONTEXT_MAX_CHARS = int(os.environ.get('DOCUMENT_CONTEXT_MAX_CHARS', 20000))
+
+def document_context_message(conversation_id):
+    """System message carrying the latest document's text for document mode, or None"""
+    # Same document the document-mode notice names; voice audio is excluded
+    document = db.session.execute(
+        select(Document)
+        .options(undefer(Document.extracted_text))
+        .where(Document.conversation_id == conversation_id, Document.mime_type.notlike('audio/%'))
+        .order_by(Document.uploaded_at.desc(), Document.id.desc())
+        .limit(1)
+    ).scalar_one_or_none()
+    if document is None:
+        return None
+    text = extract_text_from_document(document, max_chars=DOCUMENT_CONTEXT_MAX_CHARS)
+    if not text:
+        return None
+    return {
+        'role': 'system',
+        'content': (f"Answer using only the following document, '{document.filename}'. "
+                    f"If the answer is not in it, say so.\n\n{text}"),
+    }
 
-@app.route('/upload_document', methods=['POST'])
+@app.post('/upload_document')
 @login_required
 def upload_document():
     file = request.files['file']
@@ -615,16 +1021,16 @@ def upload_document():
     if file:
         try:
             # Get the conversation
-            conversation = db.session.get(Conversation, conversation_id)
-            if not conversation or conversation.user_id != current_user.id:
+            conversation = get_owned_conversation(conversation_id)
+            if not conversation:
                 flash("Unauthorized access")
                 return redirect(url_for('chat'))
             
-            # Save document to database
+            # Stream the upload to the document store and keep only its path in the database
             doc = Document(
                 conversation_id=conversation_id,
                 filename=file.filename,
-                data=file.read(),
+                storage_path=track_new_document_file(save_document_file(file)),
                 mime_type=file.mimetype
             )
             
@@ -632,12 +1038,6 @@ def upload_document():
             conversation.document_mode = True
             
             db.session.add(doc)
-            # Commit here to ensure doc and conversation mode are saved before system message
-            db.session.commit() 
-            
-            # Extract document text for context
-            # file.seek(0)  # Reset file pointer
-            # doc_text = extract_text_from_document(doc)
             
             # Create a system message to indicate document context mode
             system_message = ChatMessage(
@@ -646,8 +1046,13 @@ def upload_document():
                 content=f"📄 Document '{file.filename}' has been uploaded. My responses will now be based only on knowledge from this document."
             )
             db.session.add(system_message)
+            # Save the document, conversation mode and system message in one transaction
             db.session.commit()
             
+            # Extract document text for context without blocking the request;
+            # submitted after the commit so the worker can see the row
+            document_executor.submit(extract_document_task, doc.id)
+            
             flash("Document uploaded successfully. AI will now respond based on document content.")
         except Exception as e:
             logger.exception(f"Error uploading document: {str(e)}")
@@ -655,7 +1060,7 @@ def upload_document():
             db.session.rollback()
     return redirect(url_for('chat', conversation_id=conversation_id))
 
-@app.route('/upload_voice', methods=['POST'])
+@app.post('/upload_voice')
 @login_required 
 def upload_voice():
     if not check_whisper_model_exists():
@@ -674,72 +1079,109 @@ def upload_voice():
     if not conversation_id:
         return jsonify({'success': False, 'error': 'Missing conversation ID'}), 400
 
-    conversation = db.session.get(Conversation, conversation_id)
-    if not conversation or conversation.user_id != current_user.id:
+    conversation = get_owned_conversation(conversation_id)
+    if not conversation:
         return jsonify({'success': False, 'error': 'Conversation not found or unauthorized'}), 404
 
-    # Use a temporary file for processing
-    temp_audio_path = None
     transcription_result = None
     detected_language = None
     error_message = None
 
     try:
-        # Save blob to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_audio:
-            file.save(temp_audio.name)
-            temp_audio_path = temp_audio.name
-            logger.info(f"Saved temporary voice file to {temp_audio_path}")
-
-        # Transcribe using Whisper
-        logger.info(f"Transcribing {temp_audio_path} with language hint: {language}")
+        # Transcribe using Whisper, decoding straight from the upload stream
+        logger.info(f"Transcribing uploaded voice file with language hint: {language}")
         # Let Whisper detect language unless a specific one is strongly needed
-        whisper_options = {"language": language if language in ['english', 'persian'] else None} 
-        transcription_result = speech_service.transcribe_audio(temp_audio_path, **whisper_options)
+        transcription_result = recognize_audio_stream(file.stream, language=WHISPER_LANGUAGE_CODES.get(language))
         transcribed_text = transcription_result['text'].strip()
         detected_language = transcription_result.get('language', language)  # Use detected or fallback to hint
-        logger.info(f"Transcription successful. Detected language: {detected_language}. Text: {transcribed_text}")
+        logger.info("Transcription successful. Detected language: %s. Text: %s", detected_language, transcribed_text)
 
         if not transcribed_text:
             raise ValueError("Transcription resulted in empty text.")
 
-        # --- Save User Message (Transcription) ---
-        # Prefix with an indicator that it came from voice
-        user_message_content = f"🎤: {transcribed_text}"
-        user_message = ChatMessage(
-            conversation_id=conversation.id,
-            sender='user',
-            content=user_message_content,
-        )
-        logger.info(f"Saved user transcription message with ID: {user_message.id}")
-
         # --- Get AI Response ---
-        history = ChatMessage.query.filter_by(conversation_id=conversation.id).order_by(ChatMessage.created_at).all()
-        formatted_history = [{"role": msg.sender, "content": msg.content} for msg in history]
+        # Only the most recent messages are sent as context; fetch just the
+        # needed columns, newest first, then restore chronological order.
+        history = (ChatMessage.query
+                   .filter_by(conversation_id=conversation.id)
+                   .order_by(ChatMessage.created_at.desc())
+                   .limit(MAX_CONTEXT_MESSAGES)
+                   .with_entities(ChatMessage.sender, ChatMessage.content)
+                   .all())
+        history.reverse()
+        formatted_history = [{"role": ROLE_MAP.get(sender, 'assistant'), "content": content} for sender, content in history]
         
         # Use the transcribed text as the latest user prompt
         # No need to include the "🎤: " prefix for the AI model context
         latest_prompt = transcribed_text 
+        formatted_history.append({"role": "user", "content": latest_prompt})
+
+        # --- User Message (Transcription) ---
+        # Prefix with an indicator that it came from voice. The row is only
+        # built once the reply is in, so no write transaction is held open
+        # during the LLM call; created_at keeps the time it was received.
+        user_message_content = f"🎤: {transcribed_text}"
+        received_at = datetime.datetime.utcnow()
+        conv_id = conversation.id
+
+        def save_voice_turn(ai_response_text):
+            """Insert the transcription and (if any) the AI reply in one commit; returns the user message"""
+            user_message = ChatMessage(
+                conversation_id=conv_id,
+                sender='user',
+                content=user_message_content,
+                created_at=received_at,
+            )
+            db.session.add(user_message)
+            if ai_response_text and ai_response_text.strip():
+                db.session.add(ChatMessage(conversation_id=conv_id, sender='ai', content=ai_response_text))
+            db.session.commit()
+            logger.info(f"Saved voice chat turn, user message ID {user_message.id}")
+            return user_message
+
+        # Clients that send stream=true get the transcription first and then the
+        # AI reply as SSE chunks, instead of waiting for the full generation
+        if request.form.get('stream', 'false').lower() in ['true', '1']:
+            model_name = conversation.selected_model
+
+            def voice_response_stream():
+                yield sse_event({
+                    'transcription': user_message_content,
+                    'detected_language': detected_language,
+                })
+                full_response_parts = []
+                stream_finished = False
+                try:
+                    for sse_bytes, text in stream_llm_response(model_name, formatted_history):
+                        full_response_parts.append(text)
+                        yield sse_bytes
+                    stream_finished = True
+                finally:
+                    # --- Save both messages in one commit once the stream ends ---
+                    user_message = None
+                    try:
+                        user_message = save_voice_turn("".join(full_response_parts))
+                    except Exception as e:
+                        logger.error(f"Failed to save voice chat messages to DB: {e}")
+                        db.session.rollback()
+                # Not reached if the client disconnected mid-stream
+                if stream_finished and user_message is not None:
+                    yield sse_event({'done': True, 'message_id': user_message.id})
+
+            return Response(stream_with_context(voice_response_stream()), mimetype="text/event-stream")
 
         try:
-            logger.info(f"Sending prompt to {llm_service_type} model {conversation.selected_model}: {latest_prompt}")
+            logger.info("Sending prompt to %s model %s: %s", llm_service_type, conversation.selected_model, latest_prompt)
             # Use the new llm_service abstraction
             response = llm_service.chat(
                 model=conversation.selected_model,
                 messages=formatted_history
             )
             ai_response_text = response['message']['content']
-            logger.info(f"Received AI response: {ai_response_text}")
+            logger.info("Received AI response: %s", ai_response_text)
 
-            # --- Save AI Message ---
-            ai_message = ChatMessage(
-                conversation_id=conversation.id,
-                sender='ai',
-                content=ai_response_text,
-            )
-            db.session.add(ai_message)
-            db.session.commit()
-            logger.info(f"Saved AI response message with ID: {ai_message.id}")
+            # --- Save the transcription and AI reply together ---
+            user_message = save_voice_turn(ai_response_text)
 
             # --- Prepare JSON Response ---
             return jsonify({
@@ -753,11 +1195,19 @@ def upload_voice():
         except Exception as e:
             logger.error(f"Error getting AI response: {e}")
             error_message = f"Error getting AI response: {e}"
+            db.session.rollback()
+            # Keep the transcription even though the AI part failed
+            user_message = None
+            try:
+                user_message = save_voice_turn(None)
+            except Exception as commit_error:
+                logger.error(f"Failed to save user transcription message: {commit_error}")
+                db.session.rollback()
             # Still return success=True because transcription worked, but include error for AI part
             return jsonify({
                 'success': True,  # Transcription succeeded
                 'transcription': user_message_content,
-                'message_id': user_message.id,
+                'message_id': user_message.id if user_message else None,
                 'ai_response': None,  # Indicate AI response failed
                 'error': error_message,  # Provide error detail
                 'detected_language': detected_language,
@@ -765,17 +1215,17 @@ def upload_voice():
 
     except Exception as e:
         logger.error(f"Error processing voice file: {e}")
+        db.session.rollback()
         error_message = f"Error processing voice: {e}"
         # Return success=False as the core voice processing failed
         return jsonify({'success': False, 'error': error_message, 'transcription': error_message}), 500
-    finally:
-        # Clean up temporary file
-        if temp_audio_path and os.path.exists(temp_audio_path):
-            try:
-                os.remove(temp_audio_path)
-                logger.info(f"Removed temporary voice file: {temp_audio_path}")
-            except Exception as e:
-                logger.error(f"Error removing temporary file {temp_audio_path}: {e}")
+
+# Arabic-script block, used to detect Persian prompts
+_PERSIAN_RE = re.compile(r'[\u0600-\u06FF]')
+# "Answer in Persian"; its presence means the prompt already carries the instruction
+_PERSIAN_ANSWER_MARKER = "پاسخ به زبان فارسی"
+# "Please answer the following question in Persian:"
+_PERSIAN_INSTRUCTION_PREFIX = "لطفا به سوال زیر به زبان فارسی پاسخ دهید:\n\n"
 
 # Add a new function to call the AI model directly from backend
 def call_ai_model(model_name, prompt):
@@ -787,80 +1237,51 @@ def call_ai_model(model_name, prompt):
         logger.error(f"call_ai_model received non-string prompt: {type(prompt)}")
         raise TypeError("Prompt must be a string")
 
-    logger.info(f"Calling {llm_service_type} model {fixed_model} with prompt: {prompt[:50]}...")
+    logger.info("Calling %s model %s with prompt: %.50s...", llm_service_type, fixed_model, prompt)
 
-    # Detect if the prompt contains Persian text
-    is_persian = any('\u0600' <= c <= '\u06FF' for c in prompt)
+    # Persian prompts get a language instruction unless they already ask for a Persian answer
+    # (str.isascii is an O(1) flag check that rules out the common English case)
+    needs_persian_instruction = (not prompt.isascii()
+                                 and _PERSIAN_RE.search(prompt) is not None
+                                 and _PERSIAN_ANSWER_MARKER not in prompt)
 
-    # Add language instruction for Persian
-    if is_persian and "پاسخ به زبان فارسی" not in prompt:
-        prompt = "لطفا به سوال زیر به زبان فارسی پاسخ دهید:\n\n" + prompt
+    if needs_persian_instruction:
+        prompt = f"{_PERSIAN_INSTRUCTION_PREFIX}{prompt}"
         logger.info("Added Persian language instruction to prompt")
 
     try:
-        logger.info(f"Sending prompt to {llm_service_type} model {fixed_model}: {prompt}")
+        logger.info("Sending prompt to %s model %s: %s", llm_service_type, fixed_model, prompt)
         # Use the new llm_service abstraction
         response = llm_service.chat(
             model=fixed_model,
             messages=[{'role': 'user', 'content': prompt}]
         )
         ai_response_text = response['message']['content']
-        logger.info(f"Received AI response: {ai_response_text[:50]}...")
+        logger.info("Received AI response: %.50s...", ai_response_text)
         return ai_response_text
     except Exception as e:
         logger.exception(f"Error calling {llm_service_type} API: {e}")
         raise Exception(f"Failed to get response from AI model via API: {e}")
 
 # Add a route to get the voice recording
-@app.route('/voice_recording/<int:recording_id>', methods=['GET'])
+@app.get('/voice_recording/<int:recording_id>')
 @login_required 
 def get_voice_recording(recording_id):
     """Return the voice recording audio file"""
-    temp_file_path = None
     try:
-        # Get the document
-        voice_doc = db.session.get(Document, recording_id)
-        
-        # Check if the voice belongs to a conversation owned by the current user
-        conversation = db.session.get(Conversation, voice_doc.conversation_id)
-        if not conversation or conversation.user_id != current_user.id:
+        # Get the document, only if it belongs to a conversation owned by the current user
+        voice_doc = get_owned_document(recording_id)
+        if not voice_doc:
             return "Unauthorized", 403
         
-        # Create a temporary file to serve
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-            tmp.write(voice_doc.data)
-            temp_file_path = tmp.name
-        
-        # Send the file without using the unsupported after_request parameter
-        return send_file(
-            temp_file_path,
-            mimetype=voice_doc.mime_type,
-            as_attachment=False,
-            download_name=voice_doc.filename
-        )
+        # Serve straight from the document store; no temp copy needed
+        return send_document_file(voice_doc)
     except Exception as e:
         logger.exception(f"Error retrieving voice recording: {str(e)}")
         return f"Error retrieving voice recording: {str(e)}", 500
-    finally:
-        # Clean up the temporary file in a background thread to ensure
-        # it happens after the file is served
-        if temp_file_path and os.path.exists(temp_file_path):
-            def cleanup_temp_file():
-                try:
-                    # Add a small delay to ensure file serving completes
-                    time.sleep(1)
-                    if os.path.exists(temp_file_path):
-                        os.remove(temp_file_path)
-                except Exception as e:
-                    logger.warning(f"Failed to remove temporary file {temp_file_path}: {e}")
-            
-            import threading
-            cleanup_thread = threading.Thread(target=cleanup_temp_file)
-            cleanup_thread.daemon = True
-            cleanup_thread.start()
 
 # Update voice help route if needed, or remove if template is removed
-@app.route('/voice_help')
+@app.get('/voice_help')
 def voice_help():
     """Provides detailed instructions for setting up voice recognition"""
     # Update this template or remove the route if the template is removed
@@ -869,11 +1290,43 @@ def voice_help():
 # ===========================
 # Endpoint to Call the AI Model and Stream Response
 # ===========================
-def stream_llm_response(model_name, messages_history):
-    """Streams response from the configured LLM service."""
-    logger.info(f"--> Entering stream_llm_response for model: {model_name}")
-    logger.info(f"--> Messages history count: {len(messages_history)}")
-    logger.info(f"--> First message: {str(messages_history[0])[:100]}..." if messages_history else "No messages in history")
+# Completed replies keyed by a hash of (model, full message history), so an
+# identical conversation turn is answered without calling the LLM again.
+# LLM_RESPONSE_CACHE_SIZE=0 disables the cache.
+LLM_RESPONSE_CACHE_SIZE = int(os.environ.get('LLM_RESPONSE_CACHE_SIZE', 256))
+_response_cache = LRUCache(maxsize=max(LLM_RESPONSE_CACHE_SIZE, 1))
+_response_cache_lock = threading.Lock()
+# Splits a cached reply into word-sized pieces so the UI still animates
+_REPLAY_CHUNK_RE = re.compile(r'\s*\S+\s*|\s+')
+
+# Fixed error events, encoded once at import instead of on every failure
+EMPTY_HISTORY_SSE = sse_error("Empty message history.")
+NO_RESPONSE_SSE = sse_error("No response from model.")
+
+def stream_llm_response(model_name, messages_history, stop_event=None):
+    """Streams response from the configured LLM service as (sse_bytes, text) pairs.
+
+    Iteration stops early once stop_event is set, closing the upstream request.
+    """
+    logger.info("--> Entering stream_llm_response for model: %s", model_name)
+    logger.info("--> Messages history count: %d", len(messages_history))
+    if not messages_history:
+        # Nothing to send; don't open a request to the LLM at all
+        logger.warning("Empty message history; not calling the LLM")
+        yield EMPTY_HISTORY_SSE
+        return
+    logger.info("--> First message: %.100s...", messages_history[0])
+    
+    cache_key = None
+    if LLM_RESPONSE_CACHE_SIZE > 0:
+        cache_key = hashlib.sha256(orjson.dumps([model_name, messages_history])).digest()
+        with _response_cache_lock:
+            cached_text = _response_cache.get(cache_key)
+        if cached_text is not None:
+            logger.info("Serving cached response for model: %s", model_name)
+            for piece in _REPLAY_CHUNK_RE.findall(cached_text):
+                yield sse_event({"text": piece}), piece
+            return
     
     stream_generator = None
     sent_any_chunk = False
@@ -882,88 +1335,95 @@ def stream_llm_response(model_name, messages_history):
         # Use the new llm_service abstraction for streaming
         stream_generator = llm_service.stream_chat(model_name, messages_history)
         logger.info("--> Got generator object from llm_service.stream_chat.")
-        logger.info("--> Preparing to yield from stream_generator...")
         logger.info("--> Starting the generator iteration loop")
         try:
+            # stream_chat already yields encoded SSE messages with their text
+            response_parts = []
+            failed = False
             for chunk in stream_generator:
-                logger.info(f"Yielding chunk from llm_service.stream_chat: {str(chunk)[:60]}")
-                # Wrap every chunk in SSE format (data: ...\n\n)
-                try:
-                    if isinstance(chunk, str) and chunk.startswith('data: '):
-                        yield chunk if chunk.endswith('\n\n') else chunk + '\n\n'
-                    else:
-                        if not isinstance(chunk, str):
-                            chunk = json.dumps(chunk)
-                        yield f"data: {chunk}\n\n"
-                    sent_any_chunk = True
-                except Exception as e:
-                    logger.exception(f"Error formatting chunk for SSE: {e}")
-                    error_text = f"Error formatting chunk: {e}"
-                    escaped_text = json.dumps({"error": error_text, "text": f"⚠️ {error_text}"})
-                    yield f"data: {escaped_text}\n\n"
-                    sent_any_chunk = True
+                if stop_event is not None and stop_event.is_set():
+                    logger.info("Stop requested; closing the LLM stream.")
+                    stream_generator.close()
+                    break
+                if cache_key is not None:
+                    if is_sse_error(chunk[0]):
+                        failed = True
+                    response_parts.append(chunk[1])
+                yield chunk
+                sent_any_chunk = True
+            else:
+                # Only complete, error-free replies are cached
+                full_text = "".join(response_parts)
+                if cache_key is not None and not failed and full_text.strip():
+                    with _response_cache_lock:
+                        _response_cache[cache_key] = full_text
             logger.info("Exited stream_generator loop in stream_llm_response.")
         except Exception as e:
             logger.exception(f"Exception while iterating stream_generator: {e}")
-            error_text = json.dumps({"error": str(e), "text": f"⚠️ {str(e)}"})
-            yield f"data: {error_text}\n\n"
+            yield sse_error(str(e))
             sent_any_chunk = True
     except Exception as e:
         logger.exception(f"--> Error during llm_service.stream_chat call or yield from: {e}")
-        error_text = f"Error during {llm_service_type} stream: {e}"
-        escaped_text = json.dumps({"error": error_text, "text": f"⚠️ {error_text}"})
-        yield f"data: {escaped_text}\n\n"
+        yield sse_error(f"Error during {llm_service_type} stream: {e}")
     finally:
-        logger.info(f"--> Exiting stream_llm_response for model: {model_name}")
+        logger.info("--> Exiting stream_llm_response for model: %s", model_name)
         if not sent_any_chunk:
             logger.warning("No chunks were yielded from llm_service.stream_chat; sending empty response message.")
-            empty_text = json.dumps({"error": "No response from model.", "text": "⚠️ No response from model."})
-            yield f"data: {empty_text}\n\n"
+            yield NO_RESPONSE_SSE
 
-@app.route('/call_model', methods=['POST'])
+@app.post('/call_model')
 @login_required
 def call_model():
     logger.info(f"Received /call_model request from user {current_user.id}")
     conversation_id = request.form['conversation_id']
     prompt = request.form['prompt']
-    logger.info(f"Request details - conversation_id: {conversation_id}, prompt: {prompt[:50]}...")
+    logger.info("Request details - conversation_id: %s, prompt: %.50s...", conversation_id, prompt)
     
-    # Get conversation
-    conversation = db.session.get(Conversation, conversation_id)
-    if not conversation or conversation.user_id != current_user.id:
+    # Only the model and mode are needed here, so skip loading the full row;
+    # ownership is part of the WHERE clause
+    conversation = db.session.execute(
+        select(Conversation.selected_model, Conversation.document_mode)
+        .where(Conversation.id == conversation_id, Conversation.user_id == current_user.id)
+    ).first()
+    if not conversation:
         logger.warning(f"Unauthorized access attempt to conversation {conversation_id}")
         return jsonify({"error": "Unauthorized"}), 403
     
-    # Prepare message history
-    messages_history = []
-    for msg in conversation.messages:
-        messages_history.append({
-            'role': 'user' if msg.sender == 'user' else 'assistant',
-            'content': msg.content
-        })
+    # Prepare message history from plain (sender, content) rows rather than
+    # hydrating every ChatMessage; ix_msg_conv_created serves the ordering
+    rows = db.session.execute(
+        select(ChatMessage.sender, ChatMessage.content)
+        .where(ChatMessage.conversation_id == conversation_id)
+        .order_by(ChatMessage.created_at, ChatMessage.id)
+    ).all()
+    messages_history = [{'role': ROLE_MAP.get(sender, 'assistant'), 'content': content} for sender, content in rows]
     messages_history.append({'role': 'user', 'content': prompt})
+    if conversation.document_mode:
+        context_message = document_context_message(conversation_id)
+        if context_message:
+            messages_history.insert(0, context_message)
     
-    model_name = conversation.selected_model if hasattr(conversation, 'selected_model') and conversation.selected_model else DEFAULT_MODEL_NAME
+    model_name = conversation.selected_model or DEFAULT_MODEL_NAME
     logger.info(f"Using model: {model_name}")
     
-    # Save the user message to the DB
+    # Stage the user message; it is committed together with the AI reply once
+    # the stream ends. created_at is set now so it keeps the time it was sent.
     user_message = ChatMessage(
         conversation_id=conversation_id,
         sender='user',
-        content=prompt
+        content=prompt,
+        created_at=datetime.datetime.utcnow()
     )
     db.session.add(user_message)
-    db.session.commit()
-    logger.info(f"Saved user message with ID {user_message.id}")
     
     def response_wrapper():
         logger.info("Starting response_wrapper generator")
-        full_response = ""
+        full_response_parts = []
         ai_message_id = None
         user_id = current_user.id if hasattr(current_user, 'id') and current_user.id else 0
         conv_id = conversation_id
         generator_key = f"user_{user_id}_conv_{conv_id}"
-        active_response_generators[generator_key] = False
+        stop_event = stop_events[generator_key] = threading.Event()
         try:
             logger.info("Preparing message history for LLM API")
             logger.info(f"Streaming from ollama model {model_name}")
@@ -972,53 +1432,47 @@ def call_model():
             try:
                 logger.info("--> Entering stream_llm_response from response_wrapper...")
                 yielded_any = False
-                for chunk in stream_llm_response(model_name, messages_history):
-                    logger.info(f"Yielding chunk #{chunk_count+1}: {str(chunk)[:60]}")
-                    # Accumulate bot response text from each chunk
-                    # Each chunk should be like: 'data: {"text": "..."}\n\n'
-                    if chunk.startswith('data: '):
-                        try:
-                            data = json.loads(chunk[6:].strip())
-                            if 'text' in data:
-                                full_response += data['text']
-                        except Exception as e:
-                            logger.warning(f"Failed to parse streamed chunk for accumulation: {e}")
-                    yield chunk
+                for sse_bytes, text in stream_llm_response(model_name, messages_history, stop_event):
+                    full_response_parts.append(text)
+                    yield sse_bytes
                     yielded_any = True
                     chunk_count += 1
                 logger.info(f"Exited streaming loop after {chunk_count} chunks.")
                 if not yielded_any:
                     logger.warning("No chunks were yielded from stream_llm_response; yielding fallback error chunk.")
-                    error_text = json.dumps({"error": "No response from model.", "text": "⚠️ No response from model."})
-                    yield f"data: {error_text}\n\n"
-                # After streaming is done, save the bot message to DB
-                if full_response.strip():
-                    try:
-                        ai_message = ChatMessage(
-                            conversation_id=conversation_id,
-                            sender='ai',
-                            content=full_response
-                        )
-                        db.session.add(ai_message)
-                        db.session.commit()
-                        logger.info(f"Saved AI message with ID {ai_message.id}")
-                    except Exception as e:
-                        logger.error(f"Failed to save AI message to DB: {e}")
-                        db.session.rollback()
+                    yield NO_RESPONSE_SSE[0]
             except Exception as e:
                 logger.exception(f"Exception in streaming loop: {e}")
-                error_text = json.dumps({"error": str(e), "text": f"⚠️ {str(e)}"})
-                yield f"data: {error_text}\n\n"
+                yield sse_error(str(e))[0]
         finally:
+            # Only drop the entry if a newer stream hasn't replaced it
+            if stop_events.get(generator_key) is stop_event:
+                stop_events.pop(generator_key, None)
+            # Runs on normal completion and on client disconnect, so the user
+            # message and whatever was generated are written in one commit
+            full_response = "".join(full_response_parts)
+            try:
+                if full_response.strip():
+                    ai_message = ChatMessage(
+                        conversation_id=conversation_id,
+                        sender='ai',
+                        content=full_response
+                    )
+                    db.session.add(ai_message)
+                db.session.commit()
+                logger.info(f"Saved chat turn, user message ID {user_message.id}")
+            except Exception as e:
+                logger.error(f"Failed to save chat messages to DB: {e}")
+                db.session.rollback()
             logger.info("Exiting response_wrapper generator")
     logger.info("Returning streaming response")
     # Ensure correct mimetype for SSE and use stream_with_context
     return Response(stream_with_context(response_wrapper()), mimetype="text/event-stream")
 
-# Add a dictionary to track active response generators
-active_response_generators = {}
+# Stop signal for each active response stream, keyed by user and conversation
+stop_events = {}
 
-@app.route('/stop_response', methods=['POST'])
+@app.post('/stop_response')
 @login_required
 def stop_response():
     """Stop an active AI response for a conversation"""
@@ -1029,26 +1483,25 @@ def stop_response():
         return jsonify({"success": False, "error": "No conversation ID provided"}), 400
         
     # Check permission (user must own the conversation)
-    conversation = db.session.get(Conversation, conversation_id)
-    if not conversation or conversation.user_id != current_user.id:
+    conversation = get_owned_conversation(conversation_id)
+    if not conversation:
         return jsonify({"success": False, "error": "Unauthorized"}), 403
     
-    # Set the flag to stop the generator for this conversation
+    # Signal the generator for this conversation to stop
     generator_key = f"user_{current_user.id}_conv_{conversation_id}"
-    if generator_key in active_response_generators:
-        active_response_generators[generator_key] = True
+    stop_event = stop_events.get(generator_key)
+    if stop_event is not None:
+        stop_event.set()
         logger.info(f"Set stop flag for generator {generator_key}")
         return jsonify({"success": True, "message": "Response generation stopping"})
     else:
         return jsonify({"success": False, "error": "No active response found"}), 404
 
-@app.route('/toggle_document_mode/<int:conversation_id>', methods=['POST'])
+@app.post('/toggle_document_mode/<int:conversation_id>')
 @login_required
 def toggle_document_mode(conversation_id):
-    conversation = db.session.get(Conversation, conversation_id)
-    
-    # Check ownership
-    if conversation.user_id != current_user.id:
+    conversation = get_owned_conversation(conversation_id)
+    if not conversation:
         return jsonify({"success": False, "error": "Unauthorized"}), 403
         
     try:
@@ -1089,15 +1542,13 @@ def toggle_document_mode(conversation_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 # Add a new route to update conversation title directly
-@app.route('/conversation/<int:conversation_id>/update_title', methods=['POST'])
+@app.post('/conversation/<int:conversation_id>/update_title')
 @login_required
 def update_conversation_title(conversation_id):
     """Update a conversation title and save it to the database"""
     try:
-        conversation = db.session.get(Conversation, conversation_id)
-        
-        # Check ownership
-        if conversation.user_id != current_user.id:
+        conversation = get_owned_conversation(conversation_id)
+        if not conversation:
             return jsonify({"success": False, "error": "Unauthorized"}), 403
         
         data = request.get_json()
@@ -1120,16 +1571,14 @@ def update_conversation_title(conversation_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 # Add routes for text-to-speech capabilities
-@app.route('/voice_for_message/<int:message_id>', methods=['GET'])
+@app.get('/voice_for_message/<int:message_id>')
 @login_required
 def voice_for_message(message_id):
     """Check if a voice recording exists for a message and return it"""
     try:
-        message = db.session.get(ChatMessage, message_id)
-        
-        # Check if this message belongs to a conversation owned by the current user
-        conversation = db.session.get(Conversation, message.conversation_id)
-        if not conversation or conversation.user_id != current_user.id:
+        # Only messages in a conversation owned by the current user
+        message = get_owned_message(message_id)
+        if not message:
             return "Unauthorized", 403
         
         # Check if this is a voice response message
@@ -1147,33 +1596,8 @@ def voice_for_message(message_id):
                 ).first()
                 
                 if voice_doc:
-                    # Create a temporary file to serve
-                    temp_file_path = None
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp:
-                        tmp.write(voice_doc.data)
-                        temp_file_path = tmp.name
-                    
-                    # Function to clean up temporary file
-                    def cleanup_temp_file():
-                        try:
-                            # Add a small delay to ensure file serving completes
-                            time.sleep(1)
-                            if os.path.exists(temp_file_path):
-                                os.remove(temp_file_path)
-                        except Exception as e:
-                            logger.warning(f"Failed to remove temporary file {temp_file_path}: {e}")
-                    
-                    # Start cleanup thread
-                    cleanup_thread = threading.Thread(target=cleanup_temp_file)
-                    cleanup_thread.daemon = True
-                    cleanup_thread.start()
-                    
                     # Return the file
-                    return send_file(
-                        temp_file_path,
-                        mimetype="audio/wav",
-                        as_attachment=False
-                    )
+                    return send_document_file(voice_doc, mimetype="audio/wav")
         
         # If we get here, no voice recording was found
         return "No voice recording found for this message", 404
@@ -1182,10 +1606,73 @@ def voice_for_message(message_id):
         logger.exception(f"Error retrieving voice for message: {e}")
         return f"Error retrieving voice: {e}", 500
 
-@app.route('/synthesize_for_message', methods=['POST'])
+# Speech synthesis takes seconds, so it runs off the request thread; one
+# worker keeps concurrent jobs from competing for the TTS model
+speech_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tts')
+
+# Queued synthesis jobs: job id -> {"user_id", "status", "document_id"}.
+# Entries expire so finished jobs don't accumulate.
+SPEECH_JOB_TTL = int(os.environ.get('SPEECH_JOB_TTL', 3600))
+_speech_jobs = TTLCache(maxsize=1024, ttl=SPEECH_JOB_TTL)
+_speech_jobs_lock = threading.Lock()
+
+def _update_speech_job(job_id, **fields):
+    with _speech_jobs_lock:
+        job = _speech_jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+def synthesize_message_task(job_id, text, language, conversation_id, message_id=None):
+    """Synthesize speech in the background and store it as a voice Document"""
+    with app.app_context():
+        speech_file = None
+        try:
+            speech_file = synthesize_speech(text, language)
+            if not speech_file:
+                logger.error(f"Failed to generate speech for conversation {conversation_id}")
+                _update_speech_job(job_id, status="failed")
+                return
+            
+            # Save the speech as a document with reference to the message
+            filename = f"ai_voice_response_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            if message_id:
+                filename += f"_{message_id}"
+            filename += ".wav"
+            
+            # Move the generated file into the document store instead of
+            # reading it back into memory
+            storage_path = track_new_document_file(save_document_file(speech_file))
+            speech_file = None
+            voice_doc = Document(
+                conversation_id=conversation_id,
+                filename=filename,
+                storage_path=storage_path,
+                mime_type="audio/wav"
+            )
+            db.session.add(voice_doc)
+            db.session.commit()
+            _update_speech_job(job_id, status="done", document_id=voice_doc.id)
+            logger.info(f"Stored synthesized speech as document {voice_doc.id}")
+        except Exception as e:
+            logger.exception(f"Background speech synthesis failed: {e}")
+            db.session.rollback()
+            _update_speech_job(job_id, status="failed")
+        finally:
+            # Clean up the temporary file if it wasn't moved into the store
+            if speech_file:
+                try:
+                    os.remove(speech_file)
+                except OSError:
+                    pass
+
+@app.post('/synthesize_for_message')
 @login_required
 def synthesize_for_message():
-    """Generate text-to-speech for a message and store it"""
+    """Queue text-to-speech generation for a message.
+
+    Returns 202 right away with a poll_url that reports the job's status and,
+    once it is done, the URL of the stored audio.
+    """
     try:
         text = request.form['text']
         language = request.form.get('language', 'english')
@@ -1194,11 +1681,6 @@ def synthesize_for_message():
         if not text.strip():
             return "No text provided", 400
         
-        # Generate speech
-        speech_file = synthesize_speech(text, language) # This function needs to be defined or imported
-        if not speech_file:
-            return "Failed to generate speech", 500
-        
         # Find the associated message if message_id was provided
         if message_id:
             message = db.session.get(ChatMessage, int(message_id))
@@ -1213,68 +1695,70 @@ def synthesize_for_message():
                 return "No conversation ID provided", 400
         
         # Check user authorization for this conversation
-        conversation = db.session.get(Conversation, conversation_id)
-        if not conversation or conversation.user_id != current_user.id:
+        conversation = get_owned_conversation(conversation_id)
+        if not conversation:
             return "Unauthorized", 403
         
-        # Read the generated audio file
-        with open(speech_file, 'rb') as audio_file:
-            audio_data = audio_file.read()
-        
-        # Save the speech as a document with reference to the message
-        filename = f"ai_voice_response_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        if message_id:
-            filename += f"_{message_id}"
-        filename += ".wav"
-        
-        voice_doc = Document(
-            conversation_id=conversation_id,
-            filename=filename,
-            data=audio_data,
-            mime_type="audio/wav"
-        )
-        
-        db.session.add(voice_doc)
-        db.session.commit()
-        
-        # Clean up the temporary file
-        try:
-            os.remove(speech_file)
-        except:
-            pass
+        job_id = uuid.uuid4().hex
+        with _speech_jobs_lock:
+            _speech_jobs[job_id] = {"user_id": current_user.id, "status": "pending", "document_id": None}
+        speech_executor.submit(synthesize_message_task, job_id, text, language, conversation.id,
+                               int(message_id) if message_id else None)
         
-        # Return the audio
-        return send_file(
-            io.BytesIO(audio_data),
-            mimetype="audio/wav",
-            as_attachment=False
-        )
+        return jsonify({"status": "pending", "poll_url": url_for('speech_job_status', job_id=job_id)}), 202
     except Exception as e:
-        logger.exception(f"Error synthesizing speech: {e}")
+        logger.exception(f"Error queuing speech synthesis: {e}")
         return f"Error synthesizing speech: {e}", 500
 
-# Add a function to check system dependencies at startup
+@app.get('/speech_jobs/<job_id>')
+@login_required
+def speech_job_status(job_id):
+    """Report a queued synthesis job; once done, include the audio URL"""
+    with _speech_jobs_lock:
+        job = _speech_jobs.get(job_id)
+        job = dict(job) if job is not None else None
+    if not job or job["user_id"] != current_user.id:
+        return jsonify({"status": "unknown"}), 404
+    if job["status"] == "done":
+        return jsonify({"status": "done",
+                        "audio_url": url_for('get_voice_recording', recording_id=job["document_id"])})
+    if job["status"] == "failed":
+        return jsonify({"status": "failed"}), 500
+    return jsonify({"status": "pending"}), 202
+
+# Audio is decoded in-process by PyAV, so the only runtime dependency to
+# report is the Whisper model
 def check_system_dependencies():
+    """Report whether the Whisper model is currently loaded, without loading it"""
     deps = {
-        "ffmpeg": check_ffmpeg_installed(),
-        "whisper": check_whisper_model_exists() # Check if base model can load
+        "whisper": speech_service.whisper_model is not None,
     }
     return deps
 
-# === Add Placeholder for synthesize_speech ===
+@app.get('/healthz')
+def healthz():
+    """Liveness check; never triggers a model load.
+
+    Always 200 while the app is serving. The Whisper model loads in the
+    background (or on the first voice request), so its status is reported
+    for information only and doesn't fail the check.
+    """
+    return jsonify({"status": "ok", "dependencies": check_system_dependencies()})
+
 def synthesize_speech(text, language):
-    """Placeholder function for text-to-speech synthesis."""
-    logger.warning(f"Placeholder synthesize_speech called for language '{language}'. Text: {text[:50]}...")
-    # In a real implementation, this would call Bark via speech_service
-    # and return the path to the generated audio file.
-    # For now, return None to indicate failure.
-    # Example call (if speech_service had this method):
-    # return speech_service.synthesize_speech(text, language)
-    return None
-# === End Placeholder ===
+    """Synthesize speech with Bark via speech_service.
+
+    Returns:
+        str: Path to a temporary WAV file, or None if synthesis failed
+    """
+    result = speech_service.synthesize_speech(text, language)
+    if result is None:
+        return None
+    sample_rate, audio_data = result
+    return speech_service.save_audio_to_file(sample_rate, audio_data)
 
 # Create a session variable to store the user's LLM service preference
-@app.route('/switch_llm_service', methods=['POST'])
+@app.post('/switch_llm_service')
 @login_required
 def switch_llm_service():
     """Switch the LLM service (Ollama or Llama.cpp) for the current user"""
@@ -1296,10 +1780,11 @@ def switch_llm_service():
         
         # Create temp service to test connectivity
         try:
-            # Use the factory to create the new service
-            temp_service = LLMServiceFactory.create_service_by_type(new_service)
-            # Test listing models to ensure connectivity
-            available_models = temp_service.list_models()
+            # An explicit switch refreshes the cached service and its model list
+            get_service_instance_for_type.cache_clear()
+            with _models_cache_lock:
+                _models_cache.clear()
+            temp_service, available_models = get_llm_service_for_type(new_service)
             
             if not available_models:
                 logger.warning(f"No models found for {new_service} service")
@@ -1309,7 +1794,7 @@ def switch_llm_service():
             llm_service_type = new_service
             
             # Update the application's cached models list
-            app.config['LLM_MODELS'] = available_models if available_models else [DEFAULT_MODEL_NAME]
+            app.config['LLM_MODELS'] = list(available_models) if available_models else [DEFAULT_MODEL_NAME]
             logger.info(f"Successfully switched to {new_service} service with models: {app.config['LLM_MODELS']}")
             
             return jsonify({
@@ -1326,79 +1811,76 @@ def switch_llm_service():
         logger.exception(f"Error in switch_llm_service: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
-@app.route('/test_ollama', methods=['GET'])
+def _test_ollama_connectivity(ollama_url):
+    """Diagnostic: GET /api/tags on the Ollama host."""
+    health_url = f"{ollama_url}/api/tags"
+    logger.info(f"Testing basic connectivity to Ollama at {health_url}")
+    status_code, response_data = probe_ollama_tags(health_url)
+    return {
+        "status": f"Success ({status_code})",
+        "details": f"Connected to {health_url}",
+        # Include the first 500 chars of the response for verification
+        "response_preview": str(response_data)[:500],
+    }
+
+def _test_ollama_list_models(ollama_url):
+    """Diagnostic: list models through the active LLM service."""
+    models = list(cached_list_models(llm_service_type))
+    return {"status": "Success", "details": f"Found {len(models)} models", "models": models}
+
+def _test_ollama_completion(ollama_url):
+    """Diagnostic: simple completion without streaming."""
+    api_url = f"{ollama_url}/api/chat"
+    payload = {
+        "model": DEFAULT_MODEL_NAME,
+        "messages": [{"role": "user", "content": "Hello, say hi in one word"}],
+        "stream": False
+    }
+    logger.info(f"Testing simple completion to {api_url}")
+    response = http_session.post(api_url, json=payload, timeout=10)
+    if response.status_code == 200:
+        return {"status": "Success", "details": "Completion received", "response": str(response.json())[:500]}
+    return {
+        "status": "Failed",
+        "details": f"Error: Status {response.status_code}",
+        "response": response.text[:500],
+    }
+
+OLLAMA_DIAGNOSTICS = (
+    ("Basic connectivity test", _test_ollama_connectivity),
+    ("List models test", _test_ollama_list_models),
+    ("Simple completion test", _test_ollama_completion),
+)
+
+def _run_ollama_diagnostic(name, test, ollama_url):
+    """Run one diagnostic, turning any exception into a failed result."""
+    try:
+        result = test(ollama_url)
+    except Exception as e:
+        logger.exception(f"{name} failed: {e}")
+        result = {"status": "Failed", "details": f"Error: {str(e)}"}
+    return {"name": name, **result}
+
+@app.get('/test_ollama')
 def test_ollama():
     """
     Test connectivity to Ollama service and return detailed diagnostics.
     """
+    ollama_url = os.environ.get("OLLAMA_HOST", "http://ollama:11434")
     results = {
         "status": "Running diagnostics...",
-        "ollama_host": os.environ.get("OLLAMA_HOST", "http://ollama:11434"),
+        "ollama_host": ollama_url,
         "llm_service_type": os.environ.get("LLM_SERVICE", "ollama"),
         "tests": []
     }
     
     try:
-        # Test 1: Basic connectivity via requests
-        results["tests"].append({"name": "Basic connectivity test"})
-        try:
-            import requests
-            ollama_url = os.environ.get("OLLAMA_HOST", "http://ollama:11434")
-            health_url = f"{ollama_url}/api/tags"
-            logger.info(f"Testing basic connectivity to Ollama at {health_url}")
-            response = requests.get(health_url, timeout=5)
-            results["tests"][-1]["status"] = f"Success ({response.status_code})"
-            results["tests"][-1]["details"] = f"Connected to {health_url}"
-            
-            # Include the first 500 chars of the response for verification
-            response_data = response.json()
-            results["tests"][-1]["response_preview"] = str(response_data)[:500]
-        except Exception as e:
-            results["tests"][-1]["status"] = "Failed"
-            results["tests"][-1]["details"] = f"Error: {str(e)}"
-            logger.exception(f"Basic connectivity test failed: {e}")
-        
-        # Test 2: Try to list models
-        results["tests"].append({"name": "List models test"})
-        try:
-            models = llm_service.list_models()
-            results["tests"][-1]["status"] = "Success"
-            results["tests"][-1]["details"] = f"Found {len(models)} models"
-            results["tests"][-1]["models"] = models
-        except Exception as e:
-            results["tests"][-1]["status"] = "Failed"
-            results["tests"][-1]["details"] = f"Error: {str(e)}"
-            logger.exception(f"List models test failed: {e}")
-        
-        # Test 3: Simple completion without streaming
-        results["tests"].append({"name": "Simple completion test"})
-        try:
-            import requests
-            import json
-            
-            ollama_url = os.environ.get("OLLAMA_HOST", "http://ollama:11434")
-            api_url = f"{ollama_url}/api/chat"
-            payload = {
-                "model": DEFAULT_MODEL_NAME,
-                "messages": [{"role": "user", "content": "Hello, say hi in one word"}],
-                "stream": False
-            }
-            logger.info(f"Testing simple completion to {api_url}")
-            response = requests.post(api_url, json=payload, timeout=10)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                results["tests"][-1]["status"] = "Success"
-                results["tests"][-1]["details"] = "Completion received"
-                results["tests"][-1]["response"] = str(response_data)[:500]
-            else:
-                results["tests"][-1]["status"] = "Failed"
-                results["tests"][-1]["details"] = f"Error: Status {response.status_code}"
-                results["tests"][-1]["response"] = response.text[:500]
-        except Exception as e:
-            results["tests"][-1]["status"] = "Failed"
-            results["tests"][-1]["details"] = f"Error: {str(e)}"
-            logger.exception(f"Simple completion test failed: {e}")
+        # The tests are independent network calls, so run them concurrently;
+        # the total wait is the slowest test rather than the sum of all three
+        with ThreadPoolExecutor(max_workers=len(OLLAMA_DIAGNOSTICS)) as executor:
+            futures = [executor.submit(_run_ollama_diagnostic, name, test, ollama_url)
+                       for name, test in OLLAMA_DIAGNOSTICS]
+            results["tests"] = [future.result() for future in futures]
         
         # Overall status
         failed_tests = [t for t in results["tests"] if t.get("status", "").startswith("Failed")]
@@ -1414,18 +1896,23 @@ def test_ollama():
     
     return jsonify(results)
 
+# Log all registered routes for debugging (set DEBUG_ROUTES=1)
+if os.environ.get('DEBUG_ROUTES') and logger.isEnabledFor(logging.DEBUG):
+    logger.debug("Registered Flask routes:\n" + "\n".join(f"{rule.endpoint}: {rule}" for rule in app.url_map.iter_rules()))
+
 # Main entry point
 if __name__ == '__main__':
-    # Check dependencies
-    system_deps = check_system_dependencies()
-    if not system_deps['ffmpeg']:
-        logger.error("FFmpeg is not installed. Please install FFmpeg to use this application.")
-        # Don't exit in Docker, let it try to run
-        # exit(1) 
-    if not system_deps['whisper']:
-        logger.error("Whisper models are not available. Please install faster-whisper to use this application.")
-        # Don't exit in Docker, let it try to run
-        # exit(1)
+    # With debug=True the reloader runs this block twice: in the file-watcher
+    # parent and in the child that serves requests (WERKZEUG_RUN_MAIN=true).
+    # Only the child needs the Whisper model.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Check dependencies
+        if not check_whisper_model_exists():
+            logger.error("Whisper models are not available. Please install faster-whisper to use this application.")
+            # Don't exit in Docker, let it try to run
+            # exit(1)
+        elif WHISPER_WARMUP:
+            threading.Thread(target=warmup_whisper_model, daemon=True).start()
     
     # === Add a startup message showing the LLM service type ===
     logger.info(f"Starting AI Chat application with {llm_service_type.upper()} as the LLM service")
@@ -4,12 +4,60 @@ LLM Service module that abstracts different LLM backends (Ollama)
 import os
 import json
 import logging
+import time
+import orjson
 import requests
-from typing import List, Dict, Any, Generator, Union, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Any, Generator, Union, Optional, Tuple
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+def create_http_session() -> requests.Session:
+    """Create a requests session with keep-alive connection pooling for Ollama calls"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                          max_retries=Retry(total=2, backoff_factor=0.1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def iter_ndjson_lines(response: requests.Response) -> Generator[bytes, None, None]:
+    """Split a streamed NDJSON body into lines using a single reusable buffer
+
+    iter_content(chunk_size=None) hands over data as it arrives from the
+    socket, and consumed lines are dropped once per network read rather than
+    once per line.
+    """
+    buf = bytearray()
+    for data in response.iter_content(chunk_size=None):
+        buf += data
+        start = 0
+        while (end := buf.find(b"\n", start)) >= 0:
+            yield bytes(buf[start:end])
+            start = end + 1
+        del buf[:start]
+    if buf:
+        yield bytes(buf)
+
+# Shared by every service instance (and the app's diagnostics) so repeated
+# calls reuse open connections instead of a new TCP handshake each time
+http_session = create_http_session()
+
+def sse_event(data: Dict[str, Any]) -> bytes:
+    """Encode a payload as a single Server-Sent Events message"""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+def sse_error(error_text: str) -> Tuple[bytes, str]:
+    """Build the (sse_bytes, text) pair streamed to the client for an error"""
+    text = f"⚠️ {error_text}"
+    return sse_event({"error": error_text, "text": text}), text
+
+def is_sse_error(sse_bytes: bytes) -> bool:
+    """Whether an SSE message was built by sse_error (orjson keeps key order)"""
+    return sse_bytes.startswith(b'data: {"error"')
+
 class LLMServiceFactory:
     """Factory that creates the appropriate LLM service based on environment settings"""
     
@@ -47,12 +95,11 @@ class OllamaService:
         self.test_connection()
     
     def test_connection(self, max_retries=3, retry_delay=2):
-        import time, requests
         for attempt in range(max_retries):
             try:
                 health_url = "{}/api/tags".format(self.host)
                 logger.info("Testing connection to Ollama at {}".format(health_url))
-                response = requests.get(health_url, timeout=5)
+                response = http_session.get(health_url, timeout=5)
                 if response.status_code == 200:
                     logger.info("Successfully connected to Ollama service at {}".format(self.host))
                     return True
@@ -68,8 +115,7 @@ class OllamaService:
     
     def list_models(self) -> List[str]:
         try:
-            import requests
-            response = requests.get(f"{self.host}/api/tags", timeout=5)
+            response = http_session.get(f"{self.host}/api/tags", timeout=5)
             if response.status_code != 200:
                 logger.error(f"Failed to list models: {response.status_code} - {response.text}")
                 return []
@@ -93,9 +139,6 @@ class OllamaService:
         """
         Simplified direct API call for chat completions
         """
-        import requests
-        import json
-        
         api_url = f"{self.host}/api/chat"
         payload = {
             "model": model,
@@ -107,7 +150,7 @@ class OllamaService:
         
         if not stream:
             try:
-                response = requests.post(api_url, json=payload, timeout=30)
+                response = http_session.post(api_url, json=payload, timeout=30)
                 if response.status_code != 200:
                     logger.error(f"Ollama API error: {response.status_code} - {response.text}")
                     raise Exception(f"Ollama API returned status {response.status_code}: {response.text}")
@@ -123,11 +166,8 @@ class OllamaService:
         """
         Internal helper to handle streaming responses
         """
-        import requests
-        import json
-        
         try:
-            response = requests.post(api_url, json=payload, stream=True, timeout=60)
+            response = http_session.post(api_url, json=payload, stream=True, timeout=60)
             if response.status_code != 200:
                 logger.error(f"Ollama streaming API error: {response.status_code} - {response.text}")
                 error_msg = {"error": f"API error {response.status_code}", "text": response.text[:100]}
@@ -142,7 +182,7 @@ class OllamaService:
                 try:
                     # Parse the JSON response
                     chunk_data = json.loads(line.decode('utf-8'))
-                    logger.debug(f"Received chunk: {str(chunk_data)[:100]}...")
+                    logger.debug("Received chunk: %.100s...", chunk_data)
                     
                     # For Ollama API, extract the message content
                     if "message" in chunk_data and "content" in chunk_data["message"]:
@@ -156,9 +196,13 @@ class OllamaService:
             logger.exception(f"Error in streaming response: {e}")
             yield json.dumps({"error": str(e), "text": f"⚠️ {str(e)}"})
     
-    def stream_chat(self, model: str, messages: List[Dict[str, str]]) -> Generator:
+    def stream_chat(self, model: str, messages: List[Dict[str, str]]) -> Generator[Tuple[bytes, str], None, None]:
         """
         Stream chat completions
+
+        Yields (sse_bytes, text) pairs: the SSE message ready to be written to
+        the client, and the text fragment it carries so callers can accumulate
+        the reply without decoding the event again.
         """
         logger.info(f"Starting stream_chat for model: {model}")
         api_url = f"{self.host}/api/chat"
@@ -171,35 +215,35 @@ class OllamaService:
         logger.info(f"Payload for streaming: {str(payload)[:500]}...")
         chunk_count = 0
         stream_yielded_content = False
+        response = None
         
         try:
             # Direct API call for better error handling
-            import requests
             logger.info(f"Making streaming request to {api_url}")
             
-            response = requests.post(api_url, json=payload, stream=True, timeout=30)
+            response = http_session.post(api_url, json=payload, stream=True, timeout=30)
             
             if response.status_code != 200:
                 error_msg = f"Ollama API returned error {response.status_code}: {response.text}"
                 logger.error(error_msg)
-                escaped_text = json.dumps({"error": error_msg, "text": f"⚠️ {error_msg}"})
-                yield f"data: {escaped_text}\n\n"
+                yield sse_error(error_msg)
                 return
             
             logger.info("Successfully connected to streaming API, processing response...")
+            # Checked once so the per-token loop doesn't pay for logging calls
+            debug_enabled = logger.isEnabledFor(logging.DEBUG)
             
             # Process the streaming response line by line
-            for line in response.iter_lines():
-                if not line:
+            for line in iter_ndjson_lines(response):
+                if not line.strip():
                     continue
                 
                 chunk_count += 1
                 stream_yielded_content = True
                 
                 try:
-                    # Parse the JSON response
-                    chunk_data = json.loads(line.decode('utf-8'))
-                    logger.info(f"Received chunk {chunk_count}: {str(chunk_data)[:100]}...")
+                    # Parse the JSON response; orjson takes the raw bytes directly
+                    chunk_data = orjson.loads(line)
                     
                     # For Ollama API, extract the message content
                     chunk_text = None
@@ -207,27 +251,26 @@ class OllamaService:
                         chunk_text = chunk_data["message"]["content"]
                     
                     if chunk_text is not None:
-                        escaped_text = json.dumps({"text": chunk_text})
-                        logger.info(f"Yielding chunk {chunk_count} with text: {chunk_text[:30]}...")
-                        yield f"data: {escaped_text}\n\n"
+                        if debug_enabled:
+                            logger.debug("Yielding chunk %d with text: %.30s...", chunk_count, chunk_text)
+                        yield sse_event({"text": chunk_text}), chunk_text
                     else:
                         logger.warning(f"Could not extract text from chunk: {str(chunk_data)[:200]}")
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     logger.warning(f"Failed to decode JSON from line: {line.decode('utf-8', errors='replace')[:100]}...")
-                    error_text = f"Error parsing response: {str(e)}"
-                    escaped_text = json.dumps({"error": error_text, "text": f"⚠️ {error_text}"})
-                    yield f"data: {escaped_text}\n\n"
+                    yield sse_error(f"Error parsing response: {str(e)}")
             
             if not stream_yielded_content:
                 logger.warning("No content was yielded from the stream")
-                error_text = "No content generated by the model"
-                escaped_text = json.dumps({"error": error_text, "text": f"⚠️ {error_text}"})
-                yield f"data: {escaped_text}\n\n"
+                yield sse_error("No content generated by the model")
                 
             logger.info(f"Finished processing {chunk_count} chunks from the stream")
             
         except Exception as e:
             logger.exception(f"Error in stream_chat: {e}")
-            error_text = f"Error streaming from Ollama: {str(e)}"
-            escaped_text = json.dumps({"error": error_text, "text": f"⚠️ {error_text}"})
-            yield f"data: {escaped_text}\n\n"
+            yield sse_error(f"Error streaming from Ollama: {str(e)}")
+        finally:
+            # Also reached when the caller closes this generator early; dropping
+            # the connection tells Ollama to stop generating
+            if response is not None:
+                response.close()
@@ -0,0 +1,126 @@
+"""One-off migration for databases created before documents moved to disk.
+
+``db.create_all()`` and seeder.sql's ``CREATE TABLE IF NOT EXISTS`` never alter
+an existing table, so older deployments are missing the new columns and
+indexes. This script:
+
+  * adds ``document.storage_path`` and ``document.extracted_text``
+  * creates the listing indexes (``ix_conv_user_created``,
+    ``ix_msg_conv_created``, ``ix_document_conversation_id``)
+  * writes every ``document.data`` BLOB to DOCUMENT_STORAGE_DIR and records
+    its ``storage_path`` (one row per commit, so it can be re-run after an
+    interruption)
+  * with ``--drop-blob``, drops the old ``data`` column once every row has
+    been copied
+
+Usage:
+    python migrate_db.py [--drop-blob]
+
+It is safe to run more than once; steps that are already done are skipped.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from sqlalchemy import inspect, text
+
+from app import app, db, save_document_file, DOCUMENT_STORAGE_DIR
+
+logger = logging.getLogger("migrate_db")
+
+# (table, column, DDL) for columns added since the original schema
+NEW_COLUMNS = [
+    ('document', 'storage_path', 'ALTER TABLE document ADD COLUMN storage_path VARCHAR(512) NULL'),
+    ('document', 'extracted_text', 'ALTER TABLE document ADD COLUMN extracted_text LONGTEXT NULL'),
+]
+
+# (table, index name, DDL) for indexes added since the original schema
+NEW_INDEXES = [
+    ('conversation', 'ix_conv_user_created', 'CREATE INDEX ix_conv_user_created ON conversation (user_id, created_at)'),
+    ('chat_message', 'ix_msg_conv_created', 'CREATE INDEX ix_msg_conv_created ON chat_message (conversation_id, created_at)'),
+    ('document', 'ix_document_conversation_id', 'CREATE INDEX ix_document_conversation_id ON document (conversation_id)'),
+]
+
+def add_missing_columns(inspector):
+    for table, column, ddl in NEW_COLUMNS:
+        existing = {c['name'] for c in inspector.get_columns(table)}
+        if column in existing:
+            continue
+        logger.info(f"Adding column {table}.{column}")
+        with db.engine.begin() as conn:
+            conn.execute(text(ddl))
+
+def add_missing_indexes(inspector):
+    for table, index, ddl in NEW_INDEXES:
+        existing = {i['name'] for i in inspector.get_indexes(table)}
+        if index in existing:
+            continue
+        logger.info(f"Creating index {index} on {table}")
+        with db.engine.begin() as conn:
+            conn.execute(text(ddl))
+
+def move_blobs_to_disk():
+    """Copy each remaining BLOB into the document store; returns the number moved"""
+    with db.engine.connect() as conn:
+        ids = conn.execute(text(
+            "SELECT id FROM document WHERE storage_path IS NULL AND data IS NOT NULL"
+        )).scalars().all()
+    logger.info(f"{len(ids)} document(s) to move into {DOCUMENT_STORAGE_DIR}")
+    moved = 0
+    for document_id in ids:
+        # Fetch one BLOB at a time so large files aren't all held in memory
+        with db.engine.begin() as conn:
+            data = conn.execute(text("SELECT data FROM document WHERE id = :id"),
+                                {'id': document_id}).scalar_one()
+            storage_name = save_document_file(bytes(data))
+            try:
+                conn.execute(text("UPDATE document SET storage_path = :path WHERE id = :id"),
+                             {'path': storage_name, 'id': document_id})
+            except Exception:
+                os.remove(os.path.join(DOCUMENT_STORAGE_DIR, storage_name))
+                raise
+        moved += 1
+    return moved
+
+def drop_blob_column():
+    with db.engine.connect() as conn:
+        remaining = conn.execute(text(
+            "SELECT COUNT(*) FROM document WHERE storage_path IS NULL AND data IS NOT NULL"
+        )).scalar_one()
+    if remaining:
+        logger.error(f"{remaining} document(s) still only have BLOB data; not dropping document.data")
+        return False
+    logger.info("Dropping column document.data")
+    with db.engine.begin() as conn:
+        conn.execute(text("ALTER TABLE document DROP COLUMN data"))
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drop-blob', action='store_true',
+                        help="drop document.data after all BLOBs have been written to disk")
+    args = parser.parse_args()
+
+    with app.app_context():
+        inspector = inspect(db.engine)
+        if not inspector.has_table('document'):
+            logger.info("No document table yet; db.create_all() will create the current schema")
+            return 0
+
+        add_missing_columns(inspector)
+        add_missing_indexes(inspector)
+
+        # Re-inspect: the columns may have just changed
+        columns = {c['name'] for c in inspect(db.engine).get_columns('document')}
+        if 'data' in columns:
+            moved = move_blobs_to_disk()
+            logger.info(f"Moved {moved} document(s) to disk")
+            if args.drop_blob and not drop_blob_column():
+                return 1
+        else:
+            logger.info("document.data is already gone; nothing to move")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,6 +34,8 @@ class Conversation(db.Model):
     messages = db.relationship('ChatMessage', backref='conversation', cascade="all, delete-orphan", lazy=True)
     documents = db.relationship('Document', backref='conversation', cascade="all, delete-orphan", lazy=True)
 
+    __table_args__ = (db.Index('ix_conv_user_created', 'user_id', 'created_at'),)
+
 class ChatMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
@@ -41,10 +43,13 @@ class ChatMessage(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
+    __table_args__ = (db.Index('ix_msg_conv_created', 'conversation_id', 'created_at'),)
+
 class Document(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False, index=True)
     filename = db.Column(db.String(256))
-    data = db.Column(db.LargeBinary)
+    storage_path = db.Column(db.String(512))
+    extracted_text = db.deferred(db.Column(db.Text(length=2**32 - 1), nullable=True))
     mime_type = db.Column(db.String(128))
     uploaded_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
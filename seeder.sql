@@ -17,6 +17,7 @@ CREATE TABLE IF NOT EXISTS conversation (
     selected_model VARCHAR(64),
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     document_mode BOOLEAN DEFAULT FALSE,
+    INDEX ix_conv_user_created (user_id, created_at),
     FOREIGN KEY (user_id) REFERENCES user(id) ON DELETE CASCADE
 ) ENGINE=InnoDB;
 
@@ -26,6 +27,7 @@ CREATE TABLE IF NOT EXISTS chat_message (
     sender VARCHAR(10),
     content TEXT NOT NULL,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_msg_conv_created (conversation_id, created_at),
     FOREIGN KEY (conversation_id) REFERENCES conversation(id) ON DELETE CASCADE
 ) ENGINE=InnoDB;
 
@@ -33,9 +35,11 @@ CREATE TABLE IF NOT EXISTS document (
     id INT AUTO_INCREMENT PRIMARY KEY,
     conversation_id INT NOT NULL,
     filename VARCHAR(256),
-    data LONGBLOB,
+    storage_path VARCHAR(512),
+    extracted_text LONGTEXT,
     mime_type VARCHAR(128),
     uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_document_conversation_id (conversation_id),
     FOREIGN KEY (conversation_id) REFERENCES conversation(id) ON DELETE CASCADE
 ) ENGINE=InnoDB;
 
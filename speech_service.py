@@ -1,49 +1,93 @@
 import os
+import io
 import tempfile
 import logging
+import threading
 import torch
 import nltk
 import numpy as np
 # Import faster-whisper instead of whisper
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, BatchedInferencePipeline
 import sounddevice as sd
 from transformers import AutoProcessor, BarkModel
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Device and quantized precision for the Whisper model
+WHISPER_DEVICE = os.environ.get('WHISPER_DEVICE', "cuda" if torch.cuda.is_available() else "cpu")
+WHISPER_COMPUTE_TYPE = os.environ.get('WHISPER_COMPUTE_TYPE', "int8_float16" if WHISPER_DEVICE == "cuda" else "int8")
+# Number of audio chunks decoded together by the batched Whisper pipeline
+WHISPER_BATCH_SIZE = int(os.environ.get('WHISPER_BATCH_SIZE', 8))
+# Number of CTranslate2 workers, so concurrent requests run in parallel
+WHISPER_NUM_WORKERS = int(os.environ.get('WHISPER_NUM_WORKERS', 2))
+
+# Bark voice preset for each supported language
+BARK_VOICE_PRESETS = {
+    "english": "v2/en_speaker_1",
+    "persian": "v2/fa_speaker_1",  # Default for Persian (might need customization)
+    "fr": "v2/fr_speaker_1",
+    "es": "v2/es_speaker_1",
+    "de": "v2/de_speaker_1",
+    "it": "v2/it_speaker_1",
+    "ja": "v2/ja_speaker_1",
+}
+
 class SpeechService:
     """Service for speech recognition and synthesis using faster-whisper and Bark."""
     
     def __init__(self):
         # Initialize Whisper for speech recognition
         self.whisper_model = None
+        self.batched_model = None
+        # Guards model loading, which may race between warmup and requests
+        self._whisper_lock = threading.Lock()
         # Initialize Bark TTS
         self.tts_service = None
+        # Bark is loaded once per process; the lock stops concurrent first
+        # calls from each loading their own copy
+        self._tts_lock = threading.Lock()
         
     def load_whisper_model(self, model_name="base"):
         """Load the faster-whisper speech recognition model."""
-        if self.whisper_model is None:
-            try:
-                logger.info(f"Loading faster-whisper model: {model_name}")
-                # Pass a longer timeout (60 seconds) for downloading the model
-                self.whisper_model = WhisperModel(model_name, device="cpu", compute_type="int8")
-                logger.info("faster-whisper model loaded successfully")
-            except Exception as e:
-                logger.exception(f"Error loading faster-whisper model: {e}")
-                # Fallback to CPU with different compute type if needed
+        if self.batched_model is not None:
+            return self.whisper_model
+        with self._whisper_lock:
+            if self.whisper_model is None:
                 try:
-                    self.whisper_model = WhisperModel(model_name, device="cpu", compute_type="float32")
-                    logger.info("faster-whisper model loaded with fallback settings")
-                except Exception as e2:
-                    logger.exception(f"Fallback model loading also failed: {e2}")
-                    raise
+                    logger.info(f"Loading faster-whisper model: {model_name} ({WHISPER_DEVICE}, {WHISPER_COMPUTE_TYPE})")
+                    self.whisper_model = WhisperModel(model_name, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE_TYPE,
+                                                      num_workers=WHISPER_NUM_WORKERS)
+                    logger.info("faster-whisper model loaded successfully")
+                except Exception as e:
+                    logger.exception(f"Error loading faster-whisper model: {e}")
+                    # Fallback to CPU with different compute type if needed
+                    try:
+                        self.whisper_model = WhisperModel(model_name, device="cpu", compute_type="float32",
+                                                          num_workers=WHISPER_NUM_WORKERS)
+                        logger.info("faster-whisper model loaded with fallback settings")
+                    except Exception as e2:
+                        logger.exception(f"Fallback model loading also failed: {e2}")
+                        raise
+                # Wrap the model so audio chunks are transcribed in batches
+                self.batched_model = BatchedInferencePipeline(model=self.whisper_model)
         return self.whisper_model
     
+    def warmup(self, model_name="base"):
+        """Load the Whisper model and run one dummy inference so the first real request is fast."""
+        self.load_whisper_model(model_name)
+        # One second of silence; segments are lazy, so consume them to run the decoder
+        segments, _ = self.whisper_model.transcribe(np.zeros(16000, dtype=np.float32), language="en", beam_size=1)
+        for _ in segments:
+            pass
+        logger.info("faster-whisper model warmed up")
+    
     def get_tts_service(self):
         """Get or initialize the TTS service."""
         if self.tts_service is None:
-            self.tts_service = TextToSpeechService()
+            with self._tts_lock:
+                if self.tts_service is None:
+                    self.tts_service = TextToSpeechService()
         return self.tts_service
     
     def transcribe_audio(self, audio_data, language=None):
@@ -51,57 +95,47 @@ class SpeechService:
         Transcribe audio data to text using faster-whisper.
         
         Args:
-            audio_data: Binary audio data
+            audio_data: Binary audio data, or a float32 numpy array of 16kHz mono samples
             language: Optional language code to force language
             
         Returns:
             dict: Transcription result with text and detected language
         """
-        # Ensure Whisper model is loaded
-        if self.whisper_model is None:
+        # Ensure Whisper model is loaded (the batched pipeline is set up last)
+        if self.batched_model is None:
             self.load_whisper_model()
             
-        # Save audio data to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp:
-            temp_path = tmp.name
-            tmp.write(audio_data)
+        if isinstance(audio_data, np.ndarray):
+            # Already decoded samples can be passed to faster-whisper directly
+            audio_input = audio_data
+        else:
+            # faster-whisper decodes file-like objects in memory; no temp file needed
+            audio_input = io.BytesIO(audio_data)
         
-        try:
-            # Set transcription options
-            options = {}
-            if language:
-                options["language"] = language
-            
-            # Transcribe with faster-whisper
-            logger.info("Transcribing with faster-whisper...")
-            segments, info = self.whisper_model.transcribe(
-                temp_path,
-                language=language,
-                beam_size=5
-            )
-            
-            # Collect all segments into one text
-            text_parts = []
-            for segment in segments:
-                text_parts.append(segment.text)
-            
-            full_text = " ".join(text_parts).strip()
-            detected_language = info.language
-            
-            logger.info(f"Transcription complete: {full_text[:50]}...")
-            
-            # Return transcription and detected language
-            return {
-                "text": full_text,
-                "language": detected_language
-            }
-            
-        finally:
-            # Clean up temporary file
-            try:
-                os.remove(temp_path)
-            except Exception as e:
-                logger.warning(f"Error removing temp file: {e}")
+        # Transcribe with faster-whisper
+        logger.info("Transcribing with faster-whisper...")
+        segments, info = self.batched_model.transcribe(
+            audio_input,
+            language=language,
+            beam_size=5,
+            batch_size=WHISPER_BATCH_SIZE
+        )
+        
+        # Collect all segments into one text
+        text_parts = []
+        for segment in segments:
+            text_parts.append(segment.text)
+        
+        full_text = " ".join(text_parts).strip()
+        detected_language = info.language
+        
+        logger.info(f"Transcription complete: {full_text[:50]}...")
+        
+        # Return transcription and detected language
+        return {
+            "text": full_text,
+            "language": detected_language
+        }
     
     def synthesize_speech(self, text, language="english"):
         """
@@ -116,19 +150,8 @@ class SpeechService:
         """
         tts = self.get_tts_service()
         
-        # Map language to voice preset
-        voice_presets = {
-            "english": "v2/en_speaker_1",
-            "persian": "v2/fa_speaker_1",  # Default for Persian (might need customization)
-            "fr": "v2/fr_speaker_1",
-            "es": "v2/es_speaker_1",
-            "de": "v2/de_speaker_1",
-            "it": "v2/it_speaker_1",
-            "ja": "v2/ja_speaker_1",
-        }
-        
         # Get appropriate voice preset
-        voice_preset = voice_presets.get(language.lower(), "v2/en_speaker_1")
+        voice_preset = BARK_VOICE_PRESETS.get(language.lower(), "v2/en_speaker_1")
         
         try:
             # Generate speech with Bark
@@ -235,7 +258,8 @@ class TextToSpeechService:
                 continue
             try:
                 sample_rate, audio_array = self.synthesize(sent, voice_preset)
-                pieces += [audio_array, silence.copy()]
+                # np.concatenate copies its inputs, so the same silence block can be reused
+                pieces += [audio_array, silence]
             except Exception as synth_error:
                 logger.error(f"Error synthesizing sentence: '{sent[:30]}...': {synth_error}")
                 # Optionally skip the problematic sentence or handle differently
@@ -1,13 +1,13 @@
 import time
 import threading
 import numpy as np
-import tempfile
 import logging
 import os
 import sounddevice as sd
 from queue import Queue
 import subprocess
 import json
+import requests
 import nltk
 import torch
 import warnings
@@ -20,6 +20,11 @@ logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("VoiceAssistant")
 
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+
+# Shared session so Ollama API calls reuse one keep-alive connection
+ollama_session = requests.Session()
+
 warnings.filterwarnings(
     "ignore",
     message="torch.nn.utils.weight_norm is deprecated in favor of torch.nn.utils.parametrizations.weight_norm.",
@@ -127,45 +132,31 @@ class VoiceAssistant:
             logger.info("Stopped recording audio")
     
     def transcribe_audio(self, audio_data):
-        """Transcribe audio data to text using faster-whisper."""
-        # Save audio data to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp:
-            temp_path = tmp.name
-            tmp.write(audio_data)
+        """Transcribe raw 16 kHz mono int16 audio data to text using faster-whisper."""
+        # frombuffer reads the recorded PCM bytes in place; the samples are then
+        # scaled to the float32 [-1, 1] range faster-whisper accepts directly
+        audio = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
         
-        logger.info(f"Saved audio to temporary file: {temp_path}")
+        # Set language if specified
+        language_code = None
+        if self.language.lower() == "persian":
+            language_code = "fa"
+        elif self.language.lower() == "english":  
+            language_code = "en"
         
-        try:
-            # Set language if specified
-            language_code = None
-            if self.language.lower() == "persian":
-                language_code = "fa"
-            elif self.language.lower() == "english":  
-                language_code = "en"
-            
-            # Transcribe with faster-whisper
-            logger.info(f"Transcribing with faster-whisper (language: {language_code})...")
-            segments, info = self.whisper_model.transcribe(
-                temp_path,
-                language=language_code,
-                beam_size=5
-            )
-            
-            # Collect all segments into one text
-            text_parts = []
-            for segment in segments:
-                text_parts.append(segment.text)
-            
-            full_text = " ".join(text_parts).strip()
-            
-            logger.info(f"Transcription: {full_text}")
-            return full_text
-        finally:
-            # Clean up temporary file
-            try:
-                os.remove(temp_path)
-            except Exception as e:
-                logger.warning(f"Error removing temp file: {e}")
+        # Transcribe with faster-whisper
+        logger.info(f"Transcribing with faster-whisper (language: {language_code})...")
+        segments, info = self.whisper_model.transcribe(
+            audio,
+            language=language_code,
+            beam_size=5
+        )
+        
+        # Collect all segments into one text
+        full_text = " ".join(segment.text for segment in segments).strip()
+        
+        logger.info(f"Transcription: {full_text}")
+        return full_text
     
     def get_ollama_response(self, prompt_text):
         """Get response from Ollama model."""
@@ -177,17 +168,20 @@ class VoiceAssistant:
                 prompt_text = "لطفا به این سوال به زبان فارسی پاسخ دهید:\n\n" + prompt_text
                 logger.info("Added Persian language instruction")
             
-            cmd = ["ollama", "run", self.model_name, prompt_text]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+            result = ollama_session.post(
+                f"{OLLAMA_HOST}/api/generate",
+                json={"model": self.model_name, "prompt": prompt_text, "stream": False},
+                timeout=30,
+            )
             
-            if result.returncode != 0:
-                logger.error(f"Ollama error: {result.stderr}")
+            if not result.ok:
+                logger.error(f"Ollama error: {result.status_code} {result.text}")
                 return "Sorry, I encountered an error while processing your request."
             
-            response = result.stdout.strip()
+            response = result.json().get("response", "").strip()
             logger.info(f"Got response from Ollama: {response[:50]}...")
             return response
-        except subprocess.TimeoutExpired:
+        except requests.Timeout:
             logger.warning("Ollama response timed out")
             return "Sorry, it's taking me too long to think. Could you try a simpler question?"
         except Exception as e:
@@ -247,7 +241,7 @@ class VoiceAssistant:
                 
                 # Process audio data
                 print("Processing your speech...")
-                audio_data = b"".join(list(data_queue.queue))
+                audio_data = b"".join(data_queue.queue)
                 
                 if len(audio_data) > 0:
                     # Transcribe audio to text
@@ -270,11 +264,28 @@ class VoiceAssistant:
         print("Voice assistant session ended.")
 
 
+def list_ollama_models():
+    """Return the names of the locally available Ollama models.
+
+    Uses the Ollama HTTP API and falls back to the `ollama list` CLI if the
+    server can't be reached.
+    """
+    try:
+        response = ollama_session.get(f"{OLLAMA_HOST}/api/tags", timeout=2)
+        response.raise_for_status()
+        return [model["name"] for model in response.json().get("models", [])]
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f"Could not list models via the Ollama API, falling back to the CLI: {e}")
+        output = subprocess.run(["ollama", "list"], capture_output=True, text=True).stdout
+        # Skip the header row; the model name is the first column
+        return [line.split()[0] for line in output.splitlines()[1:] if line.strip()]
+
+
 if __name__ == "__main__":
     # Allow user to select model and language
-    available_models = subprocess.run(["ollama", "list"], capture_output=True, text=True).stdout
     print("Available Ollama models:")
-    print(available_models)
+    for name in list_ollama_models():
+        print(f"  {name}")
     
     model_name = input("Enter model name (default: llama2): ") or "llama2"
     language = input("Enter language (english/persian, default: english): ") or "english"